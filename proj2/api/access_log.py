@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+import atexit
+import os
+import queue
+import sys
+import threading
+import time
+
+
+class AccessLog:
+    DROP_POLICIES = ("drop_new", "drop_old", "block")
+
+    def __init__(self, filename=None, *, max_queue=10000, max_bytes=10 * 1024 * 1024,
+            rotate_interval=None, backup_count=5, drop_policy="drop_new",
+            block_timeout=0.1, batch_size=512):
+        if drop_policy not in AccessLog.DROP_POLICIES:
+            raise ValueError(f"unknown drop policy {drop_policy!r}, expected one of {AccessLog.DROP_POLICIES}")
+        self.filename = filename
+        self.max_queue = max_queue
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.drop_policy = drop_policy
+        self.block_timeout = block_timeout
+        self.batch_size = batch_size
+        self.written = 0
+        self.dropped = 0
+        self._fd = None
+        self._start()
+        atexit.register(self.close)
+
+    def _start(self):
+        self.queue = queue.Queue(self.max_queue)
+        self._closed = False
+        self._next_rollover = None if self.rotate_interval is None \
+                else time.time() + self.rotate_interval
+        if self.filename is not None:
+            self._fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._thread = threading.Thread(target=self._run, name="AccessLog", daemon=True)
+        self._thread.start()
+
+    def after_fork(self, filename=None):
+        # the writer thread does not survive fork(); each child gets its own
+        # queue, thread and file so workers never rotate each other's logs
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if filename is not None:
+            self.filename = filename
+        self.written = self.dropped = 0
+        self._start()
+
+    def _put(self, entry):
+        if self._closed:
+            return False
+        try:
+            if self.drop_policy == "block":
+                self.queue.put(entry, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(entry)
+            return True
+        except queue.Full:
+            pass
+        if self.drop_policy == "drop_old":
+            try:
+                self.queue.get_nowait()
+                self.queue.put_nowait(entry)
+            except (queue.Empty, queue.Full):
+                pass
+        self.dropped += 1
+        return False
+
+    def log(self, message):
+        return self._put(message)
+
+    def access(self, addr, method, uri, version, status, size, latency):
+        return self._put((time.time(), addr[0], method, uri, version, status, size, latency))
+
+    @staticmethod
+    def format(entry):
+        if entry.__class__ is str:
+            return entry + "\n"
+        stamp, host, method, uri, version, status, size, latency = entry
+        return (f'{host} - - [{time.strftime("%d/%b/%Y:%H:%M:%S %z", time.localtime(stamp))}] '
+                f'"{method} {uri} {version}" {status} {size} {latency * 1000:.3f}ms\n')
+
+    def _rotate(self):
+        os.close(self._fd)
+        for idx in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(src := f"{self.filename}.{idx}"):
+                os.replace(src, f"{self.filename}.{idx + 1}")
+        if self.backup_count:
+            os.replace(self.filename, f"{self.filename}.1")
+        else:
+            os.unlink(self.filename)
+        self._fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if self.rotate_interval is not None:
+            self._next_rollover = time.time() + self.rotate_interval
+
+    @staticmethod
+    def _flush(fd, pending):
+        data = b"".join(pending)
+        while data:
+            data = data[os.write(fd, data):]
+
+    def _write(self, lines):
+        # raw fd writes hold no interpreter-level lock a fork() could inherit
+        if self._fd is None:
+            return self._flush(sys.stdout.fileno(), [line.encode(errors="replace") for line in lines])
+        if self._next_rollover is not None and time.time() >= self._next_rollover:
+            self._rotate()
+        pending, size = [], os.fstat(self._fd).st_size
+        for line in lines:
+            line = line.encode(errors="replace")
+            if self.max_bytes and size and size + len(line) > self.max_bytes:
+                self._flush(self._fd, pending)
+                self._rotate()
+                pending, size = [], 0
+            pending.append(line)
+            size += len(line)
+        self._flush(self._fd, pending)
+
+    def _run(self):
+        while True:
+            entries = [self.queue.get()]
+            while len(entries) < self.batch_size:
+                try:
+                    entries.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = entries[-1] is None
+            if (entries := [entry for entry in entries if entry is not None]):
+                try:
+                    self._write(map(AccessLog.format, entries))
+                    self.written += len(entries)
+                except OSError:
+                    self.dropped += len(entries)
+            if stop:
+                return
+
+    def stats(self):
+        return {"queued": self.queue.qsize(), "written": self.written, "dropped": self.dropped}
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put(None)
+        self._thread.join(5)
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+from .http_server import HttpServer, HttpError, HttpResponse, RawConnection, RequestReader, Response
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from tempfile import SpooledTemporaryFile
+import asyncio
+import inspect
+import socket
+import time
+import traceback
+
+
+class AsyncRequestReader:
+    def __init__(self, reader, writer=None, *, timeout=None, max_request_line=8190,
+            max_header_size=65536, max_body_size=1048576, spool_threshold=65536, chunk_size=65536):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.max_request_line = max_request_line
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.spool_threshold = spool_threshold
+        self.chunk_size = chunk_size
+
+    async def _read(self, size):
+        # each read gets its own timeout, so a slow upload is served for as
+        # long as it keeps moving
+        if not (data := await asyncio.wait_for(self.reader.read(size), self.timeout)):
+            raise asyncio.IncompleteReadError(b"", size)
+        return data
+
+    async def read_body(self, length):
+        if length <= self.spool_threshold:
+            body = bytearray()
+            while len(body) < length:
+                body += await self._read(length - len(body))
+            return bytes(body)
+        body = SpooledTemporaryFile(self.spool_threshold)
+        try:
+            while (remaining := length - body.tell()) > 0:
+                body.write(await self._read(min(remaining, self.chunk_size)))
+        except BaseException:
+            body.close()
+            raise
+        body.seek(0)
+        return body
+
+    async def read_request(self, idle_timeout=None):
+        # idle_timeout only covers the wait for the first byte; the rest of
+        # the head must then arrive within timeout
+        if not (head := await asyncio.wait_for(self.reader.read(1), idle_timeout)):
+            return None
+        try:
+            head += await asyncio.wait_for(self.reader.readuntil(b"\r\n\r\n"), self.timeout)
+        except asyncio.IncompleteReadError:
+            raise HttpError(400, "Bad Request")
+        except asyncio.LimitOverrunError:
+            raise HttpError(431, "Request Header Fields Too Large")
+        if len(head) > self.max_header_size:
+            raise HttpError(431, "Request Header Fields Too Large")
+        elif head.find(b"\r\n") > self.max_request_line:
+            raise HttpError(414, "URI Too Long")
+        if (framing := RequestReader.scan_head(head))[0] > self.max_body_size:
+            raise HttpError(413, "Payload Too Large")
+        elif (length := framing[0]) and self.writer is not None \
+                and RequestReader.expects_continue(framing[1]):
+            self.writer.write(RequestReader.CONTINUE)
+            await self.writer.drain()
+        try:
+            return head, await self.read_body(length), framing[1]
+        except asyncio.IncompleteReadError:
+            raise HttpError(400, "Bad Request")
+
+
+class AsyncHttpServer(HttpServer):
+    def __init__(self, root_dir, *args, executor_workers=None, **kwargs):
+        super().__init__(root_dir, *args, **kwargs)
+        self._executor = ThreadPoolExecutor(executor_workers, thread_name_prefix="AsyncHttpServer")
+        self._active = 0
+        self._executor_jobs = 0
+
+    def connection_stats(self):
+        # both counters are only touched from the event loop thread
+        workers = self._executor._max_workers
+        return {"active": self._active, "workers": workers,
+                "workers_busy": min(self._executor_jobs, workers)}
+
+    def is_async_route(self, method, uri):
+        if method == "websocket":
+            return False
+        elif (table := self.router.match(uri.partition("?")[0])[0]) is None \
+                or (route := table.get(method)) is None:
+            return False
+        return inspect.iscoroutinefunction(route['handler'])
+
+    async def _detach_socket(self, writer):
+        # hand synchronous (websocket) routes a blocking duplicate of the
+        # socket and drop the transport without shutting the connection
+        raw = writer.transport.get_extra_info("socket")
+        conn = socket.socket(raw.family, raw.type, raw.proto, fileno=socket.dup(raw.fileno()))
+        conn.setblocking(True)
+        writer.transport.abort()
+        return conn
+
+    async def run_in_executor(self, fn, *args):
+        self._executor_jobs += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._executor_jobs -= 1
+
+    async def write_response(self, writer, buffers, chunks):
+        if chunks is not None:
+            # frames are produced in the executor, since templates may read
+            # the database, and each is drained before the next is made
+            while (chunk := await self.run_in_executor(next, chunks, None)) is not None:
+                buffers.append(chunk)
+                writer.writelines(buffers)
+                buffers = []
+                await writer.drain()
+        writer.writelines(buffers)
+        await writer.drain()
+
+    async def handle_http_request(self, writer, addr, request):
+        loop = asyncio.get_running_loop()
+        if (request := self.unpack_http_request(request)) is None:
+            return None
+        elif request.upgrade:
+            conn = RawConnection(await self._detach_socket(writer))
+            await loop.run_in_executor(self._executor, partial(
+                self.get_route, conn, addr, "websocket", request.uri, request=request
+                ))
+            return False
+        response = HttpResponse(None, request, self.compression)
+        if self.is_async_route(request.method, request.path):
+            result = self.get_route(response, addr, request.method, request.uri, request=request)
+        else:
+            result = await self.run_in_executor(partial(
+                self.get_route, response, addr, request.method, request.uri, request=request
+                ))
+        if inspect.isawaitable(result):
+            result = await result
+        if isinstance(result, Response):
+            response.send(result)
+        return response
+
+    async def handle_client(self, reader, writer):
+        addr = writer.get_extra_info("peername")[:2]
+        request_reader = AsyncRequestReader(reader, writer, timeout=self.request_timeout,
+                **self.reader_limits)
+        served = 0
+        self._active += 1
+        try:
+            while served < self.keepalive_max_requests:
+                try:
+                    if (request := await request_reader.read_request(
+                            self.keepalive_timeout if served else self.request_timeout
+                            )) is None:
+                        break
+                except HttpError as exc:
+                    response = HttpResponse(None)
+                    response.send(self.error_page(exc.status, exc.reason_phrase))
+                    writer.writelines(response.render(False))
+                    self.record_request(addr, response, time.monotonic())
+                    await writer.drain()
+                    break
+                except (asyncio.TimeoutError, ConnectionError):
+                    break
+                started = time.monotonic()
+                served += 1
+                if (response := await self.handle_http_request(writer, addr, request)) is False:
+                    return
+                elif response is None:
+                    break
+                keep_alive = self.is_keep_alive(response.request) \
+                        and served < self.keepalive_max_requests and not response.closed
+                if (rendered := response.render_stream(keep_alive,
+                        keepalive_timeout=self.keepalive_timeout,
+                        max_requests=self.keepalive_max_requests)) is None:
+                    response.request.close()
+                    self.record_request(addr, response, started)
+                    break
+                try:
+                    await self.write_response(writer, *rendered)
+                except ConnectionError:
+                    raise
+                except Exception:
+                    self.log(f"[AsyncHttpServer] [{self.host}:{self.port}] stream caught unhandled exception")
+                    self.log(traceback.format_exc().rstrip())
+                    break
+                finally:
+                    if rendered[1] is not None:
+                        rendered[1].close()
+                    response.request.close()
+                    self.record_request(addr, response, started)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self._active -= 1
+        writer.close()
+
+    async def serve(self):
+        self.socket.listen(self.backlog)
+        server = await asyncio.start_server(
+                self.handle_client, sock=self.socket,
+                limit=self.reader_limits['max_header_size'] + 4
+                )
+        self.log(f"[AsyncHttpServer] [{self.host}:{self.port}] serving")
+        async with server:
+            await server.serve_forever()
+
+    def handle_http_connections(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            self.log(f"[AsyncHttpServer] [{self.host}:{self.port}] caught keyboard interrupt, exiting...")
+        return self.close_connections()
+
+    def close_connections(self):
+        self.log(f"[AsyncHttpServer] [{self.host}:{self.port}] waiting on executor")
+        self._executor.shutdown(wait=True)
+        self.log(f"[AsyncHttpServer] [{self.host}:{self.port}] closed all active connections")
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class Compression:
+    TYPES = (
+            "text/", "application/javascript", "application/json",
+            "application/xml", "image/svg+xml"
+            )
+
+    def __init__(self, *, level=6, min_size=1024, static_level=9, types=TYPES):
+        self.level = level
+        self.min_size = min_size
+        self.static_level = static_level
+        self.types = types
+        self.encodings = ("br", "gzip", "deflate") if brotli is not None else ("gzip", "deflate")
+
+    def negotiate(self, accept_encoding):
+        if not accept_encoding:
+            return None
+        weights = {}
+        for coding in accept_encoding.split(","):
+            name, _, params = coding.partition(";")
+            weight = 1.0
+            if (params := params.strip()).startswith("q="):
+                try:
+                    weight = float(params[2:])
+                except ValueError:
+                    continue
+            weights[name.strip().lower()] = weight
+        for encoding in self.encodings:
+            if weights.get(encoding, weights.get("*", 0)) > 0:
+                return encoding
+        return None
+
+    def compressible(self, content_type):
+        if content_type is None:  # our own pages are sent without one
+            return True
+        content_type = content_type.lower()
+        return any(content_type.startswith(ctype) for ctype in self.types)
+
+    def compress(self, encoding, data, level=None):
+        level = self.level if level is None else level
+        if encoding == "br":
+            return brotli.compress(data, quality=min(level, 11))
+        elif encoding == "gzip":
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            return compressor.compress(data) + compressor.flush()
+        return zlib.compress(data, level)
+
+    def compressor(self, encoding):
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=min(self.level, 11))
+            return compressor.process, compressor.finish
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31 if encoding == "gzip" else 15)
+        return compressor.compress, compressor.flush
@@ -1,175 +1,1033 @@
 #!/usr/bin/env python3
-from .socket_server import SocketServer
-from urllib.parse import unquote_plus
+from .socket_server import SocketServer, send_buffers
+from .compression import Compression
+from .metrics import Metrics
+from .profiler import Profiler
+from .request import LazyField, Request, parse_pairs
+from .router import Router
+from .static_files import StaticFiles
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import chain
+from tempfile import SpooledTemporaryFile
 import os
+import queue
+import selectors
+import signal
 import socket
+import sys
 import threading
+import time
+import traceback
+
+
+class HttpError(Exception):
+    def __init__(self, status, reason_phrase):
+        super().__init__(status, reason_phrase)
+        self.status = status
+        self.reason_phrase = reason_phrase
+
+
+class RequestReader:
+    CONTINUE = b"HTTP/1.1 100 Continue\r\n\r\n"
+    # consulted for every request, so they are kept from the framing pass
+    # and Request only parses the rest of the head when a handler asks
+    KEPT_HEADERS = (b"connection", b"expect", b"accept-encoding")
+
+    def __init__(self, conn, *, buffer=None, timeout=None, chunk_size=65536, max_request_line=8190,
+            max_header_size=65536, max_body_size=1048576, spool_threshold=65536):
+        self.conn = conn
+        self.timeout = timeout
+        self.deadline = None
+        self.chunk_size = chunk_size
+        self.max_request_line = max_request_line
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.spool_threshold = spool_threshold
+        self.buffer = bytearray() if buffer is None else buffer
+        self.expect_continue = False
+        self._scanned = 0
+        self._framed = None
+        self._spool = None
+
+    def _fill(self):
+        if self.deadline is not None:
+            # a timeout per recv alone would let a client trickle its head in
+            # forever, so the head as a whole must arrive by the deadline
+            if self._framed is not None:
+                self.conn.settimeout(self.timeout)
+            elif (remaining := self.deadline - time.monotonic()) > 0:
+                self.conn.settimeout(remaining)
+            else:
+                raise TimeoutError("request head deadline passed")
+        if not (data := self.conn.recv(self.chunk_size)):
+            return False
+        self.buffer += data
+        return True
+
+    @staticmethod
+    def scan_head(head):
+        length, headers = None, {}
+        for line in head.split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            if (name := name.strip().lower()) == b"transfer-encoding":
+                # chunked bodies aren't decoded, and guessing their end would
+                # desync every pipelined request after them
+                raise HttpError(501, "Not Implemented")
+            elif name == b"content-length":
+                for value in value.split(b","):  # "5, 5" repeats one length
+                    if not (value := value.strip()).isdigit() or length not in (None, int(value)):
+                        raise HttpError(400, "Bad Request")
+                    length = int(value)
+            elif name in RequestReader.KEPT_HEADERS:
+                name, value = name.decode(), value.strip().decode(errors="replace")
+                headers[name] = f"{headers[name]}, {value}" if name in headers else value
+        if length is not None:
+            headers['content-length'] = str(length)
+        return length or 0, headers
+
+    @staticmethod
+    def expects_continue(headers):
+        return "100-continue" in headers.get("expect", "").lower()
+
+    def frame_request(self):
+        if self._framed is None:
+            if (end := self.buffer.find(b"\r\n\r\n", self._scanned)) == -1:
+                self._scanned = max(0, len(self.buffer) - 3)
+                if self.buffer.find(b"\r\n", 0, self.max_request_line + 2) == -1 \
+                        and len(self.buffer) > self.max_request_line:
+                    raise HttpError(414, "URI Too Long")
+                elif len(self.buffer) > self.max_header_size:
+                    raise HttpError(431, "Request Header Fields Too Large")
+                return None
+            elif end > self.max_header_size:
+                raise HttpError(431, "Request Header Fields Too Large")
+            elif self.buffer.find(b"\r\n", 0, end + 2) > self.max_request_line:
+                raise HttpError(414, "URI Too Long")
+            length, headers = self.scan_head(self.buffer[:end + 4])
+            if length > self.max_body_size:
+                raise HttpError(413, "Payload Too Large")
+            self._framed = (end + 4, length, headers)
+            if length > self.spool_threshold:
+                self._spool = SpooledTemporaryFile(self.spool_threshold)
+            self.expect_continue = len(self.buffer) < end + 4 + length \
+                    and self.expects_continue(headers)
+        head_length, length, headers = self._framed
+        if self._spool is not None:
+            # large bodies move out of the read buffer as they arrive
+            if (take := min(length - self._spool.tell(), len(self.buffer) - head_length)) > 0:
+                with memoryview(self.buffer) as view:
+                    self._spool.write(view[head_length:head_length + take])
+                del self.buffer[head_length:head_length + take]
+            if self._spool.tell() < length:
+                return None
+            body, self._spool = self._spool, None
+            body.seek(0)
+            length = 0
+        elif len(self.buffer) < head_length + length:
+            return None
+        else:
+            body = bytes(self.buffer[head_length:head_length + length])
+        head = bytes(self.buffer[:head_length])
+        del self.buffer[:head_length + length]
+        self._scanned = 0
+        self._framed = None
+        return head, body, headers
+
+    def read_request(self):
+        while (request := self.frame_request()) is None:
+            if self.expect_continue:
+                self.expect_continue = False
+                self.conn.sendall(RequestReader.CONTINUE)
+            if not self._fill():
+                if self.buffer or self._framed is not None:
+                    raise HttpError(400, "Bad Request")
+                return None
+        return request
+
+
+@lru_cache(maxsize=128)
+def status_line(version, status, reason_phrase):
+    return f"{version} {status} {reason_phrase}".encode()
+
+
+@lru_cache(maxsize=1024)
+def header_line(name, value):
+    return f"{name.split('#', 1)[0]}: {value}".encode()
+
+
+class Response:
+    __slots__ = ("status", "headers", "body", "stream")
+
+    def __init__(self, status, headers=(), body=(), stream=None):
+        self.status = status
+        self.headers = list(headers)
+        self.body = list(body)
+        self.stream = stream
+
+    @classmethod
+    def parse(cls, data):
+        head, _, body = bytes(data).partition(b"\r\n\r\n")
+        status, *headers = head.split(b"\r\n")
+        return cls(status, headers, (body,) if body else ())
+
+    def __len__(self):
+        return sum(map(len, self.body))
+
+    def __bytes__(self):
+        return b"".join(self.buffers())
+
+    def buffers(self):
+        return [b"\r\n".join((self.status, *self.headers, b"", b"")), *self.body]
+
+
+class RawConnection:
+    __slots__ = ("conn",)
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def send(self, data):
+        if data.__class__ is Response:
+            send_buffers(self.conn, data.buffers())
+        else:
+            self.conn.sendall(data)
+        return len(data)
+
+    sendall = send
+
+
+class HttpResponse:
+    BODILESS_STATUSES = (b"101", b"204", b"304")
+    HOP_BY_HOP = (b"connection", b"content-length", b"keep-alive", b"transfer-encoding")
+    CHUNK_SIZE = 16384
+
+    def __init__(self, conn, request=None, compression=None):
+        self.conn = conn
+        self.request = request
+        self.compression = compression
+        self.closed = False
+        self.file = None
+        self.response = None
+        self.size = 0
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def send(self, data):
+        if data.__class__ is not Response:
+            if self.response is not None:
+                self.response.body.append(bytes(data))
+                return len(data)
+            data = Response.parse(data)
+        if self.response is None:
+            self.response = data
+        else:
+            self.response.body.extend(data.buffers())
+        return len(data)
+
+    sendall = send
+
+    def send_file(self, head, file, size):
+        self.response = Response.parse(head)
+        self.file = (file, size)
+        return size
+
+    def close(self):
+        self.closed = True
+
+    def _iter_chunks(self, stream):
+        pending, size = [], 0
+        for chunk in stream:
+            if chunk.__class__ is str:
+                chunk = chunk.encode()
+            elif not chunk:
+                continue
+            pending.append(chunk)
+            if (size := size + len(chunk)) >= HttpResponse.CHUNK_SIZE:
+                self.size += size
+                yield b"%x\r\n%b\r\n" % (size, b"".join(pending))
+                pending, size = [], 0
+        self.size += size
+        if size:
+            yield b"%x\r\n%b\r\n0\r\n\r\n" % (size, b"".join(pending))
+        else:
+            yield b"0\r\n\r\n"
+
+    def _compress_stream(self, encoding, stream):
+        compress, flush = self.compression.compressor(encoding)
+        for chunk in stream:
+            yield compress(chunk.encode() if chunk.__class__ is str else chunk)
+        yield flush()
+
+    def _compress(self, response):
+        content_type = vary = None
+        for hdr in response.headers:
+            name, _, value = hdr.partition(b":")
+            if (name := name.strip().lower()) == b"content-encoding":
+                return
+            elif name == b"content-type":
+                content_type = value.strip().decode("latin-1")
+            elif name == b"vary":
+                vary = value.lower()
+        if not self.compression.compressible(content_type) \
+                or (response.stream is None and len(response) < self.compression.min_size):
+            return
+        if vary is None or b"accept-encoding" not in vary:
+            response.headers.append(b"Vary: Accept-Encoding")
+        if (encoding := self.compression.negotiate(self.request.get("Accept-Encoding"))) is None:
+            return
+        response.headers.append(b"Content-Encoding: %s" % encoding.encode())
+        if response.stream is not None:
+            response.stream = self._compress_stream(encoding, response.stream)
+        else:
+            response.body = [self.compression.compress(encoding, b"".join(response.body))]
+
+    def _prepare(self, keep_alive, keepalive_timeout, max_requests, include_file):
+        response = self.response
+        chunked = response.stream is not None and self.request is not None \
+                and self.request.version != "HTTP/1.0"
+        if response.stream is not None and not chunked:
+            response.body.extend(
+                    chunk.encode() if chunk.__class__ is str else chunk
+                    for chunk in response.stream
+                    )
+            response.stream = None
+        elif chunked and response.body:
+            response.stream, response.body = chain(response.body, response.stream), []
+        response.headers = [
+                hdr for hdr in response.headers
+                if hdr.split(b":", 1)[0].strip().lower() not in HttpResponse.HOP_BY_HOP
+                ]
+        if self.compression is not None and self.request is not None and self.file is None \
+                and response.status[9:12] not in HttpResponse.BODILESS_STATUSES:
+            self._compress(response)
+        length = len(response)
+        if self.file is not None:
+            length += self.file[1]
+            if include_file:
+                with self.file[0] as file:
+                    response.body.append(file.read(self.file[1]))
+                self.file = None
+        self.size = length  # chunked bodies add to it as they are framed
+        if chunked:
+            response.headers.append(b"Transfer-Encoding: chunked")
+        elif response.status[9:12] not in HttpResponse.BODILESS_STATUSES:
+            response.headers.append(b"Content-Length: %d" % length)
+        if keep_alive:
+            response.headers.append(b"Connection: keep-alive")
+            if keepalive_timeout is not None:
+                response.headers.append(b"Keep-Alive: timeout=%d, max=%d" % (keepalive_timeout, max_requests))
+        else:
+            response.headers.append(b"Connection: close")
+        return response
+
+    def render_stream(self, keep_alive, *, keepalive_timeout=None, max_requests=None):
+        # the head's buffers, plus an iterator of chunked frames for a
+        # streamed body so the caller can write them one at a time
+        if self.response is None:
+            return None
+        response = self._prepare(keep_alive and not self.closed,
+                keepalive_timeout, max_requests, True)
+        chunks = None if response.stream is None else self._iter_chunks(response.stream)
+        response.stream = None
+        return response.buffers(), chunks
+
+    def render(self, keep_alive, *, keepalive_timeout=None, max_requests=None):
+        if (rendered := self.render_stream(keep_alive, keepalive_timeout=keepalive_timeout,
+                max_requests=max_requests)) is None:
+            return None
+        buffers, chunks = rendered
+        if chunks is not None:
+            buffers.extend(chunks)
+        return buffers
+
+    def finish(self, keep_alive, *, keepalive_timeout=None, max_requests=None):
+        if self.response is None:
+            return False
+        keep_alive = keep_alive and not self.closed
+        response = self._prepare(keep_alive, keepalive_timeout, max_requests, False)
+        buffers = response.buffers()
+        if response.stream is not None:
+            # the head rides with the first chunk and the terminator with the
+            # last, so small streams still leave in one write
+            self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            for chunk in self._iter_chunks(response.stream):
+                buffers.append(chunk)
+                send_buffers(self.conn, buffers)
+                buffers = []
+            response.stream = None
+            return keep_alive
+        send_buffers(self.conn, buffers)
+        if self.file is not None:
+            with self.file[0] as file:
+                self.conn.sendfile(file, 0, self.file[1])  # os.sendfile on Linux
+            self.file = None
+        return keep_alive
+
 
-                        
 class HttpServer(SocketServer):
     SUPPORTED_HTTP_VERSION = "HTTP/1.1"
     DEFAULT_ERROR = SUPPORTED_HTTP_VERSION \
             + " {status} {reason_phrase}\r\n\r\n<html><body><h1>{status} - {reason_phrase}</h1><p>This resource is inaccessible.</p></body></html>"
     INTERNAL_ERRORS = ("/404", "/405", "/400")
 
-    def __init__(self, root_dir, *args, max_conn=10, **kwargs):
+    def __init__(self, root_dir, *args, static_max_age=0,
+            static_immutable_max_age=31536000, max_conn=10, queue_depth=64, backlog=128,
+            queue_timeout=5, retry_after=5, request_timeout=10,
+            keepalive_timeout=5, keepalive_max_requests=100,
+            max_request_line=8190, max_header_size=65536,
+            max_body_size=1048576, spool_threshold=65536, compress_level=6,
+            compress_min_size=1024, **kwargs):
         super().__init__(*args, **kwargs)
         if not os.path.exists(root_dir):
-            print(f"[HttpServer] [{self.host}:{self.port}] {root_dir!r} doesn't exist")
+            self.log(f"[HttpServer] [{self.host}:{self.port}] {root_dir!r} doesn't exist")
             raise FileNotFoundError
         self.root_dir = root_dir
+        self.compression = None if compress_level is None else Compression(
+                level=compress_level, min_size=compress_min_size
+                )
+        self.static_files = StaticFiles(
+                root_dir, max_age=static_max_age,
+                immutable_max_age=static_immutable_max_age,
+                compression=self.compression
+                )
         self.max_conn = max_conn
-        self._routes = {}
+        self.queue_depth = queue_depth
+        self.backlog = backlog
+        self.queue_timeout = queue_timeout
+        self.service_unavailable = (
+                f"{HttpServer.SUPPORTED_HTTP_VERSION} 503 Service Unavailable\r\n"
+                f"Retry-After: {retry_after}\r\n"
+                "Content-Length: 0\r\n"
+                "Connection: close\r\n\r\n"
+                ).encode()
+        self.admission = {"accepted": 0, "queued": 0, "shed_full": 0, "shed_deadline": 0}
+        self._admission_lock = threading.Lock()
+        self.request_timeout = request_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.keepalive_max_requests = keepalive_max_requests
+        self.reader_limits = {
+                "max_request_line": max_request_line,
+                "max_header_size": max_header_size,
+                "max_body_size": max_body_size,
+                "spool_threshold": spool_threshold
+                }
+        self.router = Router()
+        self._routes = self.router.routes
+        self._error_pages = {}
         self._threads = []
+        self._busy = []
+        self._idle = OrderedDict()
+        self._opening = OrderedDict()
+        self._parked = deque()
+        self.metrics = Metrics()
+        self._register_metrics()
+        self.profiler = Profiler()
+
+    def _register_metrics(self):
+        metrics = self.metrics
+        metrics.counter("http_requests_total", "Requests served, by route, method and status.",
+                ("route", "method", "status"))
+        metrics.histogram("http_request_duration_seconds", "Time from a request being read "
+                "to its response being written.", ("route", "method"))
+        metrics.counter("http_request_bytes_total", "Request bytes read, by route.", ("route",))
+        metrics.counter("http_response_bytes_total", "Response body bytes written, by route.",
+                ("route",))
+        metrics.gauge("http_connections_active", "Open client connections.",
+                lambda: self.connection_stats()['active'])
+        metrics.gauge("http_workers", "Worker threads handling requests.",
+                lambda: self.connection_stats()['workers'])
+        metrics.gauge("http_workers_busy", "Worker threads currently handling a request.",
+                lambda: self.connection_stats()['workers_busy'])
+        metrics.gauge("http_queue_pending", "Connections or requests waiting for a worker.",
+                lambda: self.admission_stats()['pending'])
+        metrics.gauge("http_queue_capacity", "Maximum number of waiting connections or requests.",
+                lambda: self.queue_depth)
+        metrics.gauge("http_admission_total", "Admission control outcomes.",
+                lambda: {(key,): value for key, value in self.admission.items()},
+                ("outcome",), kind="counter")
+        metrics.gauge("access_log_dropped_total", "Log entries dropped because the queue was full.",
+                lambda: self.logger.dropped, kind="counter")
+
+    @staticmethod
+    def admin_response(content_type, body, *headers):
+        return Response(
+                status_line(HttpServer.SUPPORTED_HTTP_VERSION, 200, "OK"),
+                [header_line("Content-Type", content_type), b"Cache-Control: no-store", *headers],
+                [body]
+                )
+
+    def add_admin_route(self, path, handler, *, allow=("127.0.0.1", "::1")):
+        def admin(server, conn, addr, method, params, route, cookies):
+            if allow is not None and addr[0] not in allow:
+                return server.route_error(conn, addr, 404, "Not Found", cookies)
+            return handler(server, conn, addr, method, params, route, cookies)
+        return self.add_route(["GET"], path, admin)
+
+    def add_metrics_route(self, path="/metrics", *, allow=("127.0.0.1", "::1")):
+        def metrics(server, conn, addr, method, params, route, cookies):
+            return conn.send(server.admin_response(Metrics.CONTENT_TYPE,
+                    server.metrics.render().encode()))
+        return self.add_admin_route(path, metrics, allow=allow)
+
+    def add_profiler_route(self, path="/_profiler", *, allow=("127.0.0.1", "::1")):
+        def profiler(server, conn, addr, method, params, route, cookies):
+            query, profiler = params['GET'], server.profiler
+            if query.get("format") == "pstats":
+                if (data := profiler.export(query.get("route", ""))) is None:
+                    return server.route_error(conn, addr, 404, "Not Found", cookies)
+                return conn.send(server.admin_response("application/octet-stream", data,
+                        header_line("Content-Disposition",
+                            f'attachment; filename="{Profiler.filename(query["route"])}"')))
+            if "reset" in query:
+                profiler.reset()
+            if any(key in query for key in ("enable", "every", "routes")):
+                try:
+                    profiler.configure(
+                            enabled=query['enable'] not in ("", "0", "false") if "enable" in query else None,
+                            every=query.get("every") or None,
+                            routes=[r for r in query['routes'].split(",") if r] if "routes" in query else None
+                            )
+                except ValueError:
+                    return server.route_error(conn, addr, 400, "Bad Request", cookies)
+            dumped = profiler.dump() if "dump" in query else []
+            limit = query.get("limit", "20")
+            return conn.send(server.admin_response("text/plain; charset=utf-8", (
+                    f"enabled: {profiler.enabled}\nevery: {profiler.every}\n"
+                    f"routes: {', '.join(sorted(profiler.routes))}\n"
+                    + "".join(f"dumped: {path}\n" for path in dumped) + "\n"
+                    + profiler.summary(query.get("route"), sort=query.get("sort", "cumulative"),
+                        limit=int(limit) if limit.isdigit() else 20)
+                    ).encode()))
+        return self.add_admin_route(path, profiler, allow=allow)
 
     @staticmethod
     def parse_http_request(data):
-        try:
-            preamble, content = data.split("\r\n\r\n", 1)
-            method_line, *headers = preamble.split("\r\n")
-            method, uri, version = method_line.split(" ", 2)
-            headers = {
-                    hdr.split(": ", 1)[0]: hdr.split(": ", 1)[1]
-                    for hdr in headers
-                    }
-            cookies = {}
-            if 'Cookie' in headers:
-                for pair in headers['Cookie'].split("&"):
-                    pair = pair.split("=")
-                    cookies[pair[0]] = unquote_plus(pair[1])
-        except (ValueError, IndexError):
-            headers = {}
-            content = ""
-        else:
-            headers.update({
-                ":method": method,
-                ":uri": uri,
-                ":version": version,
-                ":cookies": cookies
-                })
-        return headers, content
+        if isinstance(data, str):
+            data = data.encode()
+        head, _, body = data.partition(b"\r\n\r\n")
+        return Request.parse(head, body, kept_headers=RequestReader.scan_head(head)[1])
+
+    @staticmethod
+    def is_keep_alive(request):
+        connection = request.get("connection", "").lower()
+        if request.version == "HTTP/1.0":
+            return "keep-alive" in connection
+        return "close" not in connection
 
     def add_route(self, methods_supported, path, handler):
-        if path in self._routes:
-            print(f"[HttpServer] [{self.host}:{self.port}] tried to ovewrite existing route, {path!r}")
-            return False
         if '?' in path:
-            print(f"[HttpServer] [{self.host}:{self.port}] invalid character in path '?'")
+            self.log(f"[HttpServer] [{self.host}:{self.port}] invalid character in path '?'")
             return False
-        print(f"[HttpServer] [{self.host}:{self.port}] adding route {path!r}")
-        self._routes[path] = {
+        elif not self.router.add(methods_supported, path, {
                     "methods_supported": methods_supported,
                     "handler": handler,
                     "host": path,
                     "origin": None
-                }
+                }):
+            self.log(f"[HttpServer] [{self.host}:{self.port}] tried to ovewrite existing route, {path!r}")
+            return False
+        self.log(f"[HttpServer] [{self.host}:{self.port}] adding route {path!r}")
+        return True
 
     def redirect_route(self, src_path, dst_path, *, inherit_methods=False):
         if src_path == dst_path:
             return False
-        elif src_path not in self._routes or dst_path not in self._routes:
+        elif src_path not in self._routes and src_path not in self.router.aliases:
             return False
-        print(f"[HttpServer] [{self.host}:{self.port}] redirecting {src_path!r} to {dst_path!r}")
-        ms = self._routes[src_path]['methods_supported']
-        self._routes[src_path] = self._routes[dst_path]
-        self._routes[src_path]["origin"] = src_path
-        if not inherit_methods:
-            self._routes[src_path]['methods_supported'] = ms
+        elif dst_path not in self._routes and dst_path not in self.router.aliases:
+            return False
+        self.log(f"[HttpServer] [{self.host}:{self.port}] redirecting {src_path!r} to {dst_path!r}")
+        self.router.alias(src_path, dst_path, inherit_methods)
         return True
 
     def remove_route(self, path):
-        if path not in self._routes:
+        if not self.router.remove(path):
             return False
-        print(f"[HttpServer] [{self.host}:{self.port}] removing route {path!r}")
-        del self._routes[path]
+        self.log(f"[HttpServer] [{self.host}:{self.port}] removing route {path!r}")
         return True
 
-    def get_route(self, conn, addr, method, path, *, content=None, cookies={}, _error=False):
-        print(f"[HttpServer] [{addr[0]}:{addr[1]}] {method} {path!r}")
-        params = {"GET": {}, "POST": {}}
-        if '?' in path and not _error:
+    def error_page(self, status, reason_phrase):
+        if (page := self._error_pages.get((status, reason_phrase))) is None:
+            page = self._error_pages[status, reason_phrase] = HttpServer.DEFAULT_ERROR.format(
+                    status=status, reason_phrase=reason_phrase).encode()
+        return page
+
+    def route_error(self, conn, addr, status, reason_phrase, cookies={}):
+        if (table := self.router.match(f"/{status}", prefix=False)[0]) is not None \
+                and (route := table.get("GET")) is not None:
+            return route['handler'](self, conn, addr, "GET",
+                    {"GET": {}, "POST": {}, "PATH": {}}, route, cookies)
+        return conn.send(self.error_page(status, reason_phrase))
+
+    def get_route(self, conn, addr, method, path, *, content=None, cookies={}, request=None):
+        path, _, query = path.partition("?")
+        if request is not None:
+            params = {
+                    "GET": LazyField(request, "query"),
+                    "POST": LazyField(request, "form") if method == "POST" else {},
+                    "PATH": {}
+                    }
+            cookies = request if method == "websocket" else LazyField(request, "cookies")
+        else:
+            params = {
+                    "GET": parse_pairs(query, "&"),
+                    "POST": parse_pairs(content or "", "&") if method == "POST" else {},
+                    "PATH": {}
+                    }
+
+        table, params["PATH"] = self.router.match(path,
+                prefix=path not in HttpServer.INTERNAL_ERRORS)
+        if table is None:
+            return self.route_error(conn, addr, 404, "Not Found", cookies)
+        elif (route := table.get(method)) is None:
+            return self.route_error(conn, addr, 405, "Method Unsupported", cookies)
+        elif route['host'].endswith("/*"):
+            params["path"] = path
+        if request is not None:
+            request.route = route['host']
+        if not (self.profiler.enabled and self.profiler.sampled(route['host'])) \
+                or (profile := self.profiler.start()) is None:
+            return route['handler'](self, conn, addr, method, params, route, cookies)
+        try:
+            result = route['handler'](self, conn, addr, method, params, route, cookies)
+        except BaseException:
+            self.profiler.finish(route['host'], profile)
+            raise
+        # keep the sample running while a streamed body is rendered
+        if (response := result if result.__class__ is Response
+                else getattr(conn, "response", None)).__class__ is Response \
+                and response.stream is not None:
+            response.stream = self.profiler.finish(route['host'], profile, response.stream)
+        else:
+            self.profiler.finish(route['host'], profile)
+        return result
+
+    def record_request(self, addr, response, started):
+        latency = time.monotonic() - started
+        request = response.request
+        status = "-" if response.response is None \
+                else response.response.status[9:12].decode(errors="replace")
+        if request is None:
+            self.logger.access(addr, "-", "-", "-", status, response.size, latency)
+            method, route, size = "-", "-", 0
+        else:
+            self.logger.access(addr, request.method, request.uri, request.version, status,
+                    response.size, latency)
+            # unmatched requests share one label so clients can't mint new series
+            method, route, size = (request.method, request.route, request.size) \
+                    if request.route is not None else ("-", "-", request.size)
+        metrics = self.metrics
+        metrics.inc("http_requests_total", (route, method, status))
+        metrics.observe("http_request_duration_seconds", (route, method), latency)
+        metrics.inc("http_request_bytes_total", (route,), size)
+        metrics.inc("http_response_bytes_total", (route,), response.size)
+
+    def send_error(self, conn, addr, status, reason_phrase):
+        started = time.monotonic()
+        response = HttpResponse(conn)
+        response.send(self.error_page(status, reason_phrase))
+        try:
+            response.finish(False)
+        except OSError:
+            pass
+        self.record_request(addr, response, started)
+
+    def unpack_http_request(self, request):
+        head, body, headers = request
+        return Request.parse(head, body, spool_threshold=self.reader_limits['spool_threshold'],
+                kept_headers=headers)
+
+    def handle_http_request(self, conn, addr, request):
+        if (request := self.unpack_http_request(request)) is None:
+            return None
+        elif request.upgrade:
+            self.get_route(RawConnection(conn), addr, "websocket", request.uri, request=request)
+            return False  # the route now owns the socket
+        response = HttpResponse(conn, request, self.compression)
+        if isinstance(result := self.get_route(response, addr, request.method, request.uri,
+                request=request), Response):
+            response.send(result)
+        return response
+
+    def count_admission(self, key):
+        with self._admission_lock:
+            self.admission[key] += 1
+
+    def connection_stats(self):
+        if hasattr(self, "_reactor_conns"):
+            workers = self._cpu_workers
+            return {"active": len(self._reactor_conns), "workers": workers,
+                    "workers_busy": min(self._reactor_inflight, workers)}
+        busy = sum(self._busy)
+        return {"active": busy + len(self._idle) + len(self._opening), "workers": len(self._busy), "workers_busy": busy}
+
+    def admission_stats(self):
+        return {
+                **self.admission,
+                "shed": self.admission['shed_full'] + self.admission['shed_deadline'],
+                "pending": self._queue.qsize() if hasattr(self, "_queue") \
+                        else getattr(self, "_reactor_inflight", 0)
+                }
+
+    def shed_connection(self, conn, reason):
+        self.count_admission(reason)
+        try:
+            conn.setblocking(False)
             try:
-                params["GET"] = {pair.split("=")[0]: unquote_plus(pair.split("=")[1]) for pair in path.split("?", 1)[1].split("&")}
-            except IndexError:
-                return conn.send(self.get_route(conn, addr, "GET", "/400", _error=(400, "Bad Request")).encode())
-            path = path.split("?")[0]
+                conn.recv(65536)  # unread data would turn close() into a reset
+            except (BlockingIOError, OSError):
+                pass
+            conn.settimeout(1)
+            conn.sendall(self.service_unavailable)
+            conn.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        conn.close()
 
-        if method == "POST":
+    def _enqueue_request(self, conn, addr, state=None):
+        self.count_admission("accepted")
+        try:
+            self._queue.put_nowait((conn, addr, state, time.monotonic()))
+        except queue.Full:
+            self.shed_connection(conn, "shed_full")
+        else:
+            self.count_admission("queued")
+        return True
+
+    def _park(self, conn, addr, state):
+        # an idle keep-alive connection waits in the acceptor's selector
+        # rather than holding a worker until its next request arrives
+        self._parked.append((conn, addr, state))
+        try:
+            self._park_waker[1].send(b"\0")
+        except BlockingIOError:
+            pass
+
+    def handle_http_connection(self, conn, addr, state=None):
+        if state is None:
+            state = {"reader": RequestReader(conn, timeout=self.request_timeout, **self.reader_limits),
+                     "served": 0}
+        reader = state['reader']
+        if self.request_timeout is not None:
+            reader.deadline = time.monotonic() + self.request_timeout
+        try:
+            if (request := reader.read_request()) is None:
+                return conn.close()
+        except HttpError as exc:
+            conn.settimeout(self.request_timeout)
+            self.send_error(conn, addr, exc.status, exc.reason_phrase)
+            return conn.close()
+        except OSError:
+            return conn.close()
+        conn.settimeout(self.request_timeout)
+        started = time.monotonic()
+        state['served'] += 1
+        if (response := self.handle_http_request(conn, addr, request)) is False:
+            return
+        elif response is None:
+            return conn.close()
+        keep_alive = False
+        try:
+            keep_alive = response.finish(
+                    self.is_keep_alive(response.request)
+                    and state['served'] < self.keepalive_max_requests,
+                    keepalive_timeout=self.keepalive_timeout,
+                    max_requests=self.keepalive_max_requests)
+        except OSError:
+            pass
+        finally:
+            self.record_request(addr, response, started)
+            response.request.close()
+        if not keep_alive:
+            return conn.close()
+        elif reader.buffer:
+            # a pipelined request goes back through admission like any other
+            return self._enqueue_request(conn, addr, state)
+        self._park(conn, addr, state)
+
+    def _worker(self, idx):
+        while (item := self._queue.get()) is not None:
+            conn, addr, state, enqueued = item
+            if time.monotonic() - enqueued > self.queue_timeout:
+                self.shed_connection(conn, "shed_deadline")
+                continue
+            self._busy[idx] = True
             try:
-                params["POST"] = {pair.split("=")[0]: unquote_plus(pair.split("=")[1]) for pair in content.split("&")}
-            except IndexError:
-                return conn.send(self.get_route(conn, addr, "GET", "/400", _error=(400, "Bad Request")).encode())
- 
-        if path not in self._routes or _error:
-            if _error:
-                return HttpServer.DEFAULT_ERROR.format(
-                        status=_error[0],
-                        reason_phrase=_error[1]
-                        )
-            
-            if '/*' in self._routes and path not in HttpServer.INTERNAL_ERRORS:
-                return self._routes['/*']['handler'](self, conn, addr, method, {"path": path}, None, cookies)
-            return conn.send(self.get_route(conn, addr, "GET", "/404", _error=(404, "Not Found")).encode())
-
-        elif method not in self._routes[path]['methods_supported']:
-            return conn.send(self.get_route(conn, addr, "GET", "/405", _error=(405, "Method Unsupported")).encode())
-        
-        return (route := self._routes[path])['handler'](self, conn, addr, method, params, route, cookies)
+                self.handle_http_connection(conn, addr, state)
+            except Exception:
+                self.log(f"[HttpServer] [{self.host}:{self.port}] worker caught unhandled exception")
+                self.log(traceback.format_exc().rstrip())
+                conn.close()
+            finally:
+                self._busy[idx] = False
 
     def handle_http_connections(self):
-        def handler(conn, addr):
-            conn.settimeout(1)
-            data = ""
+        self._queue = queue.Queue(self.queue_depth)
+        self._busy = [False] * self.max_conn
+        self._threads = [
+                threading.Thread(target=self._worker, args=(idx,), name=f"HttpServer-worker-{idx}",
+                    daemon=True)
+                for idx in range(self.max_conn)
+                ]
+        for thd in self._threads:
+            thd.start()
+        self.log(f"[HttpServer] [{self.host}:{self.port}] started {self.max_conn} worker threads")
+        self._park_waker = socket.socketpair()
+        for sock in self._park_waker:
+            sock.setblocking(False)
+        selector = selectors.DefaultSelector()
+        self.socket.listen(self.backlog)
+        self.socket.setblocking(False)
+        selector.register(self.socket, selectors.EVENT_READ, "accept")
+        selector.register(self._park_waker[0], selectors.EVENT_READ, "wake")
+        try:
+            while True:
+                for key, _ in selector.select(1):
+                    if key.data == "accept":
+                        self._accept_connections(selector)
+                    elif key.data == "wake":
+                        try:
+                            while self._park_waker[0].recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    else:  # the first or next request on a waiting connection
+                        selector.unregister(conn := key.fileobj)
+                        addr, state, _ = (self._idle if key.data == "idle" else self._opening).pop(conn)
+                        self._enqueue_request(conn, addr, state)
+                while self._parked:
+                    conn, addr, state = self._parked.popleft()
+                    self._idle[conn] = (addr, state, time.monotonic())
+                    selector.register(conn, selectors.EVENT_READ, "idle")
+                self._expire(selector, self._idle, self.keepalive_timeout)
+                self._expire(selector, self._opening, self.request_timeout)
+        except KeyboardInterrupt:
+            self.log(f"[HttpServer] [{self.host}:{self.port}] caught keyboard interrupt, exiting...")
+        for waiting in (self._idle, self._opening):
+            for conn in waiting:
+                conn.close()
+            waiting.clear()
+        selector.close()
+        return self.close_connections()
+
+    @staticmethod
+    def _expire(selector, waiting, timeout):
+        if timeout is None:
+            return
+        # added in order, so the oldest are always at the front
+        deadline = time.monotonic() - timeout
+        while waiting and next(iter(waiting.values()))[2] < deadline:
+            conn, _ = waiting.popitem(last=False)
+            selector.unregister(conn)
+            conn.close()
+
+    def _accept_connections(self, selector):
+        while True:
             try:
-                while (recv := conn.recv(1).decode()):
-                    data += recv
-            except socket.timeout:
-                pass
-            conn.settimeout(None)
-            headers, content = self.parse_http_request(data)
+                conn, addr = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:  # e.g. EMFILE; the listener stays readable
+                self.log(f"[HttpServer] [{self.host}:{self.port}] accept failed: {exc}")
+                return
+            conn.setblocking(True)
+            self.log(f"[SocketServer] [{self.host}:{self.port}] received connection from {addr[0]}:{addr[1]}")
+            # a connection only takes a worker once its first request arrives,
+            # so silent ones (e.g. browser preconnects) wait here instead
+            self._opening[conn] = (addr, None, time.monotonic())
+            selector.register(conn, selectors.EVENT_READ, "opening")
+
+    def _reactor_dispatch(self, rconn, request, enqueued=None):
+        keep_alive = streaming = False
+        started = time.monotonic() if enqueued is None else enqueued
+        try:
+            if enqueued is not None and time.monotonic() - enqueued > self.queue_timeout:
+                self.count_admission("shed_deadline")
+                return rconn.write(self.service_unavailable, close=True)
+            if (request := self.unpack_http_request(request)) is None:
+                return rconn.close()
+            elif request.upgrade:
+                return self.get_route(RawConnection(rconn.detach()), rconn.addr, "websocket",
+                        request.uri, request=request)
+            response = HttpResponse(None, request, self.compression)
+            if isinstance(result := self.get_route(response, rconn.addr, request.method,
+                    request.uri, request=request), Response):
+                response.send(result)
+            rconn.state['served'] += 1
+            keep_alive = self.is_keep_alive(request) and not response.closed \
+                    and rconn.state['served'] < self.keepalive_max_requests
+            if (rendered := response.render_stream(keep_alive,
+                    keepalive_timeout=self.keepalive_timeout,
+                    max_requests=self.keepalive_max_requests)) is None:
+                request.close()
+                self.record_request(rconn.addr, response, started)
+                keep_alive = False
+                return rconn.close()
+            data, chunks = rendered
+            if chunks is None:
+                request.close()
+                self.record_request(rconn.addr, response, started)
+                return rconn.write(data, close=not keep_alive)
+            # nothing more is read from the connection until the stream ends
+            streaming = True
+            rconn.pause()
+            rconn.write(data)
+            self._reactor_stream(rconn, response, chunks, keep_alive, started)
+        except Exception:
+            self.log(f"[HttpServer] [{self.host}:{self.port}] reactor dispatch caught unhandled exception")
+            self.log(traceback.format_exc().rstrip())
+            keep_alive = False
+            rconn.close()
+        finally:
+            if enqueued is not None:
+                with self._admission_lock:
+                    self._reactor_inflight -= 1
+            if keep_alive and not streaming and rconn.paused:
+                rconn.resume()
+
+    def _reactor_stream(self, rconn, response, chunks, keep_alive, started):
+        # writes one frame, then produces the next only once the socket has
+        # drained, so a slow client holds back the handler rather than memory
+        chunk = None
+        if not rconn.closing:
             try:
-                if headers.get("Connection") == "Upgrade":
-                    method = "websocket"
-                    cookies = headers
-                else:
-                    method = headers[':method']
-                    cookies = headers[':cookies']
-                uri = headers[':uri']
-            except KeyError:
-                return conn.close()
-            
-            self.get_route(conn, addr, method, uri, content=content, cookies=cookies)
-            if method != "websocket":
-                return conn.close()
+                chunk = next(chunks, None)
+            except Exception:
+                self.log(f"[HttpServer] [{self.host}:{self.port}] reactor stream caught unhandled exception")
+                self.log(traceback.format_exc().rstrip())
+                keep_alive = False
+        if chunk is not None:
+            resume = partial(self._reactor_stream, rconn, response, chunks, keep_alive, started)
+            return rconn.write(chunk, on_drain=resume if self._cpu_pool is None
+                    else partial(self._cpu_pool.submit, resume))
+        chunks.close()
+        response.request.close()
+        self.record_request(rconn.addr, response, started)
+        if not keep_alive:
+            rconn.close()
+        elif not rconn.closing:
+            rconn.resume()
+
+    def _reactor_on_data(self, rconn):
+        if rconn.state is None:
+            rconn.state = {
+                    "reader": RequestReader(None, buffer=rconn.rbuf, **self.reader_limits),
+                    "served": 0
+                    }
+        while not (rconn.paused or rconn.closing or rconn.detached):
+            try:
+                if (request := rconn.state['reader'].frame_request()) is None:
+                    if rconn.state['reader'].expect_continue:
+                        rconn.state['reader'].expect_continue = False
+                        rconn.write(RequestReader.CONTINUE)
+                    return
+            except HttpError as exc:
+                response = HttpResponse(None)
+                response.send(self.error_page(exc.status, exc.reason_phrase))
+                rconn.write(response.render(False), close=True)
+                return self.record_request(rconn.addr, response, time.monotonic())
+            if self._cpu_pool is None:
+                self._reactor_dispatch(rconn, request)
+            elif self._reactor_inflight >= self.queue_depth:
+                self.count_admission("shed_full")
+                return rconn.write(self.service_unavailable, close=True)
+            else:
+                rconn.pause()
+                with self._admission_lock:
+                    self._reactor_inflight += 1
+                    self.admission['queued'] += 1
+                self._cpu_pool.submit(self._reactor_dispatch, rconn, request, time.monotonic())
 
-        def delegate_handler(*args, **kwargs):
-            self._threads[0] += 1
-            self._threads.append(threading.Thread(
-                target=handler, args=args, kwargs=kwargs
-                ))
-            self._threads[-1].start()
-            print(f"[HttpServer] [{self.host}:{self.port}] spawned worker thread")
-            return True
+    def handle_http_reactor(self, *, cpu_workers=0):
+        self._cpu_pool = ThreadPoolExecutor(cpu_workers, thread_name_prefix="HttpServer-cpu") \
+                if cpu_workers else None
+        self._reactor_inflight = 0
+        self._cpu_workers = cpu_workers
+        super().handle_reactor_connections(
+                self._reactor_on_data, backlog=self.backlog,
+                idle_timeout=self.keepalive_timeout
+                )
+        self.log(f"[HttpServer] [{self.host}:{self.port}] reactor exited")
+        if self._cpu_pool is not None:
+            self._cpu_pool.shutdown(wait=True)
 
-        self._threads = [0]
-        while True:
-            while self._threads[0] < self.max_conn:
-                print(f"[HttpServer] [{self.host}:{self.port}] delegating new worker thread")
-                if not super().handle_raw_connection(delegate_handler, timeout=1):
-                    print(f"[HttpServer] [{self.host}:{self.port}] caught keyboard interrupt, exiting...")
-                    return self.close_connections()
-            print(f"[HttpServer] [{self.host}:{self.port}] idling while active threads exit")
-            for idx, thd in enumerate(self._threads[1:]):
-                if not thd.is_alive():
-                    print(f"[HttpServer] [{self.host}:{self.port}] killing dead thread")
-                    self._threads[0] -= 1
-                    try:
-                        del self._threads[idx+1]
-                    except IndexError:
-                        continue
+    def _prefork_child(self, idx, serve, kwargs):
+        def stop(signum, frame):
+            # a repeated signal must not interrupt the shutdown itself
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            raise KeyboardInterrupt
+
+        if self.logger_file is not None:
+            base, ext = os.path.splitext(self.logger_file)
+            self.logger.after_fork(f"{base}.worker{idx}{ext}")
+        else:
+            self.logger.after_fork()
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, stop)
+        if self.reuse_port:
+            self.socket.close()
+            self.socket = self.bind_socket()
+        try:
+            getattr(self, serve)(**kwargs)
+        except KeyboardInterrupt:
+            pass
+        raise SystemExit(0)
+
+    def handle_http_prefork(self, workers=None, *, serve="handle_http_connections",
+            restart_delay=1, **kwargs):
+        workers = workers or os.cpu_count()
+        if not self.reuse_port:
+            self.socket.listen(self.backlog)
+        children = {}
+        stopping = False
+
+        def spawn(idx):
+            sys.stdout.flush()
+            if not (pid := os.fork()):
+                self._prefork_child(idx, serve, kwargs)
+            children[pid] = idx
+            self.log(f"[HttpServer] [{self.host}:{self.port}] started worker #{idx} (pid {pid})")
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        for idx in range(workers):
+            spawn(idx)
+        if self.reuse_port:
+            self.socket.close()
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            if (idx := children.pop(pid, None)) is None or stopping:
+                continue
+            self.log(f"[HttpServer] [{self.host}:{self.port}] worker #{idx} (pid {pid}) exited "
+                  f"with status {os.waitstatus_to_exitcode(status)}, restarting")
+            time.sleep(restart_delay)
+            if not stopping:
+                spawn(idx)
+        self.log(f"[HttpServer] [{self.host}:{self.port}] all workers exited")
 
     def close_connections(self):
-        print(f"[HttpServer] [{self.host}:{self.port}] closing all active connections")
-        for idx, thd in enumerate(self._threads[1:]):
+        self.log(f"[HttpServer] [{self.host}:{self.port}] closing all active connections")
+        for _ in self._threads:
+            self._queue.put(None)
+        for thd in self._threads:
             thd.join()
-        print(f"[HttpServer] [{self.host}:{self.port}] closed all active connections")
+        while self._parked:
+            self._parked.popleft()[0].close()
+        self.log(f"[HttpServer] [{self.host}:{self.port}] closed all active connections")
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+from bisect import bisect_left
+from functools import wraps
+import threading
+import time
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape_label(value):
+    return str(value).replace("\\", r"\\").replace('"', r'\"').replace("\n", r"\n")
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+class Metrics:
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.families = {}
+        self._shards = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def counter(self, name, help, labels=()):
+        self.families[name] = ("counter", help, tuple(labels), None)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.families[name] = ("histogram", help, tuple(labels), tuple(buckets))
+
+    def gauge(self, name, help, collect, labels=(), *, kind="gauge"):
+        # collect() runs at scrape time and returns a number, or a mapping of
+        # label value tuples to numbers; kind="counter" exports running totals
+        self.families[name] = (kind, help, tuple(labels), collect)
+
+    def _shard(self):
+        # every thread updates its own dicts, so the request path never
+        # takes a lock; shards are only merged when /metrics is scraped
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def inc(self, name, labels=(), value=1):
+        shard = self._shard()
+        shard[name, labels] = shard.get((name, labels), 0) + value
+
+    def observe(self, name, labels, value):
+        shard = self._shard()
+        buckets = self.families[name][3]
+        if (cells := shard.get((name, labels))) is None:
+            cells = shard[name, labels] = [0] * (len(buckets) + 3)  # buckets, +Inf, sum, count
+        cells[bisect_left(buckets, value)] += 1
+        cells[-2] += value
+        cells[-1] += 1
+
+    def timed(self, name, help, buckets=LATENCY_BUCKETS):
+        self.histogram(name, help, buckets=buckets)
+
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(name, (), time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    def collect(self):
+        merged = {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for key, value in list(shard.items()):
+                if value.__class__ is list:
+                    merged[key] = [a + b for a, b in zip(merged.get(key, [0] * len(value)), value)]
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def render(self):
+        merged = self.collect()
+        series = {}
+        for (name, labels), value in merged.items():
+            series.setdefault(name, []).append((labels, value))
+        lines = []
+        for name, (kind, help, labelnames, extra) in self.families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if callable(extra):
+                if not isinstance(values := extra(), dict):
+                    values = {(): values}
+                for labels, value in values.items():
+                    lines.append(f"{name}{format_labels(labelnames, labels)} {value}")
+            elif kind == "histogram":
+                for labels, cells in sorted(series.get(name, ())):
+                    cumulative = 0
+                    for bound, count in zip((*extra, "+Inf"), cells):
+                        cumulative += count
+                        le = f'le="{bound}"'
+                        lines.append(f"{name}_bucket{format_labels(labelnames, labels, le)} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labelnames, labels)} {cells[-2]}")
+                    lines.append(f"{name}_count{format_labels(labelnames, labels)} {cells[-1]}")
+            else:
+                for labels, value in sorted(series.get(name, ())):
+                    lines.append(f"{name}{format_labels(labelnames, labels)} {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+from io import StringIO
+import cProfile
+import itertools
+import marshal
+import os
+import pstats
+import re
+import threading
+
+
+class Profiler:
+    SORT_KEYS = ("cumulative", "tottime", "calls", "ncalls", "time", "name")
+
+    def __init__(self, *, every=0, routes=(), directory=None):
+        self.every = every
+        self.routes = set(routes)
+        self.directory = directory
+        self.enabled = False
+        self.stats = {}
+        self.samples = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def configure(self, *, enabled=None, every=None, routes=None, directory=None):
+        if every is not None:
+            self.every = max(0, int(every))
+        if routes is not None:
+            self.routes = set(routes)
+        if directory is not None:
+            self.directory = directory
+        self.enabled = bool(self.every or self.routes) if enabled is None else bool(enabled)
+        return self.enabled
+
+    def sampled(self, route):
+        # next() on itertools.count is atomic under the GIL, so sampling
+        # needs no lock either
+        return route in self.routes or bool(self.every and not next(self._counter) % self.every)
+
+    def _enable(self, profile):
+        # a nested enable() replaces the outer profiler without complaint on
+        # some Pythons (3.11 among them), so each thread tracks its own
+        if getattr(self._local, "active", False):
+            return False
+        try:
+            profile.enable()
+        except ValueError:  # another profiler is already active
+            return False
+        self._local.active = True
+        return True
+
+    def _disable(self, profile):
+        profile.disable()
+        self._local.active = False
+
+    def start(self):
+        return profile if self._enable(profile := cProfile.Profile()) else None
+
+    def finish(self, route, profile, stream=None):
+        # a streamed body is produced after the handler returns, possibly on
+        # another thread, so profiling resumes around each chunk instead
+        self._disable(profile)
+        if stream is None:
+            return self._record(route, profile)
+        return self._profiled(route, profile, iter(stream))
+
+    def _profiled(self, route, profile, stream):
+        try:
+            while True:
+                enabled = self._enable(profile)
+                try:
+                    chunk = next(stream)
+                except StopIteration:
+                    return
+                finally:
+                    if enabled:
+                        self._disable(profile)
+                yield chunk
+        finally:
+            self._record(route, profile)
+
+    def _record(self, route, profile):
+        with self._lock:
+            if (stats := self.stats.get(route)) is None:
+                self.stats[route] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            self.samples[route] = self.samples.get(route, 0) + 1
+
+    def runcall(self, route, fn, *args):
+        if (profile := self.start()) is None:
+            return fn(*args)
+        try:
+            return fn(*args)
+        finally:
+            self.finish(route, profile)
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+            self.samples.clear()
+
+    def summary(self, route=None, *, sort="cumulative", limit=20):
+        if sort not in Profiler.SORT_KEYS:
+            sort = "cumulative"
+        out = StringIO()
+        with self._lock:
+            for name, stats in sorted(self.stats.items()):
+                if route is not None and name != route:
+                    continue
+                out.write(f"== {name} ({self.samples[name]} samples) ==\n")
+                stats.stream = out
+                stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def export(self, route):
+        with self._lock:
+            if (stats := self.stats.get(route)) is None:
+                return None
+            return marshal.dumps(stats.stats)  # the format pstats.Stats() loads
+
+    @staticmethod
+    def filename(route):
+        return (re.sub(r"[^\w.-]+", "_", route.replace("*", "wildcard")).strip("_") or "root") \
+                + ".pstats"
+
+    def dump(self, directory=None):
+        if (directory := directory or self.directory) is None:
+            return []
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for route in list(self.stats):
+            if (data := self.export(route)) is None:
+                continue
+            with open((path := os.path.join(directory, self.filename(route))), "wb") as file:
+                file.write(data)
+            paths.append(path)
+        return paths
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+from collections.abc import Mapping
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from urllib.parse import unquote_plus
+
+
+def parse_pairs(data, separator):
+    pairs = {}
+    for pair in data.split(separator):
+        if not (pair := pair.strip()):
+            continue
+        name, _, value = pair.partition("=")
+        pairs[unquote_plus(name)] = unquote_plus(value)
+    return pairs
+
+
+def header_params(value):
+    value, *params = value.split(";")
+    pairs = {}
+    for param in params:
+        name, _, param = param.partition("=")
+        pairs[name.strip().lower()] = param.strip().strip('"')
+    return value.strip().lower(), pairs
+
+
+class UploadedFile:
+    __slots__ = ("name", "filename", "content_type", "file", "size")
+
+    def __init__(self, name, filename, content_type, file):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.file = file
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return self.file.write(data)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    def close(self):
+        self.file.close()
+
+
+def parse_multipart(stream, boundary, *, spool_threshold=65536, chunk_size=65536,
+        max_part_header=16384):
+    delimiter = b"\r\n--" + boundary.encode("latin-1")
+    buffer = bytearray(b"\r\n")  # lets the first boundary match like the rest
+    fields, files = {}, {}
+
+    def fill():
+        if not (data := stream.read(chunk_size)):
+            return False
+        buffer.extend(data)
+        return True
+
+    while (idx := buffer.find(delimiter)) == -1:
+        del buffer[:max(0, len(buffer) - len(delimiter))]
+        if not fill():
+            return fields, files
+    del buffer[:idx + len(delimiter)]
+    while True:
+        while len(buffer) < 2 and fill():
+            pass
+        if buffer[:2] != b"\r\n":  # "--" closes the body, anything else is malformed
+            break
+        while (end := buffer.find(b"\r\n\r\n")) == -1:
+            if len(buffer) > max_part_header or not fill():
+                return fields, files
+        headers = {}
+        for line in bytes(buffer[2:end]).decode(errors="replace").split("\r\n"):
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        del buffer[:end + 4]
+        _, disposition = header_params(headers.get("content-disposition", ""))
+        name = disposition.get("name", "")
+        if "filename" in disposition:
+            sink = files[name] = UploadedFile(name, disposition['filename'],
+                    headers.get("content-type", "application/octet-stream"),
+                    SpooledTemporaryFile(spool_threshold))
+        else:
+            sink = BytesIO()
+        while (idx := buffer.find(delimiter)) == -1:
+            if (safe := len(buffer) - len(delimiter) + 1) > 0:
+                with memoryview(buffer) as view:
+                    sink.write(view[:safe])
+                del buffer[:safe]
+            if not fill():
+                return fields, files
+        with memoryview(buffer) as view:
+            sink.write(view[:idx])
+        del buffer[:idx + len(delimiter)]
+        if sink.__class__ is BytesIO:
+            fields[name] = sink.getvalue().decode(errors="replace")
+        else:
+            sink.seek(0)
+    return fields, files
+
+
+class LazyField(Mapping):
+    __slots__ = ("request", "field")
+
+    def __init__(self, request, field):
+        self.request = request
+        self.field = field
+
+    def __getitem__(self, key):
+        return getattr(self.request, self.field)[key]
+
+    def __iter__(self):
+        return iter(getattr(self.request, self.field))
+
+    def __len__(self):
+        return len(getattr(self.request, self.field))
+
+    def __repr__(self):
+        return repr(getattr(self.request, self.field))
+
+
+class Request:
+    __slots__ = ("method", "uri", "version", "head", "body", "spool_threshold", "size", "route",
+            "kept_headers", "_headers", "_cookies", "_query", "_form", "_files")
+    KEPT_HEADERS = ("connection", "content-length", "expect", "accept-encoding")
+
+    def __init__(self, method, uri, version, head=b"", body=b"", *, spool_threshold=65536,
+            kept_headers=None):
+        self.method = method
+        self.uri = uri
+        self.version = version
+        self.head = head
+        self.body = body
+        self.spool_threshold = spool_threshold
+        self.size = 0
+        self.route = None
+        self.kept_headers = kept_headers
+        self._headers = None
+        self._cookies = None
+        self._query = None
+        self._form = None
+        self._files = None
+
+    @classmethod
+    def parse(cls, head, body=b"", **kwargs):
+        size = len(head) + (len(body) if isinstance(body, bytes) else body.seek(0, 2))
+        request_line, _, head = head.partition(b"\r\n")
+        try:
+            method, uri, version = request_line.decode(errors="replace").split()
+        except ValueError:
+            return None
+        request = cls(method, uri, version, head, body, **kwargs)
+        request.size = size
+        return request
+
+    @property
+    def path(self):
+        return self.uri.partition("?")[0]
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            headers = {}
+            for line in self.head.split(b"\r\n"):
+                name, sep, value = line.partition(b":")
+                if not sep or not (name := name.strip()):
+                    continue
+                name = name.decode(errors="replace").lower()
+                value = value.strip().decode(errors="replace")
+                if name in headers:  # repeated fields fold into one list
+                    value = f"{headers[name]}{'; ' if name == 'cookie' else ', '}{value}"
+                headers[name] = value
+            self._headers = headers
+        return self._headers
+
+    def _lookup(self, name):
+        # the reader already picked these out of the head while framing it
+        if self._headers is None and self.kept_headers is not None and name in Request.KEPT_HEADERS:
+            return self.kept_headers
+        return self.headers
+
+    def get(self, name, default=None):
+        return self._lookup(name := name.lower()).get(name, default)
+
+    def __getitem__(self, name):
+        return self._lookup(name := name.lower())[name]
+
+    def __contains__(self, name):
+        return (name := name.lower()) in self._lookup(name)
+
+    @property
+    def upgrade(self):
+        return "upgrade" in self.get("connection", "").lower()
+
+    @property
+    def cookies(self):
+        if self._cookies is None:
+            self._cookies = parse_pairs(self.get("cookie", ""), ";")
+        return self._cookies
+
+    @property
+    def query(self):
+        if self._query is None:
+            self._query = parse_pairs(self.uri.partition("?")[2], "&")
+        return self._query
+
+    @property
+    def stream(self):
+        if isinstance(self.body, bytes):
+            return BytesIO(self.body)
+        self.body.seek(0)
+        return self.body
+
+    @property
+    def content(self):
+        return (self.body if isinstance(self.body, bytes) else self.stream.read()) \
+                .decode(errors="replace")
+
+    def _parse_form(self):
+        self._form, self._files = {}, {}
+        content_type, params = header_params(
+                self.get("content-type", "application/x-www-form-urlencoded"))
+        if content_type == "application/x-www-form-urlencoded":
+            self._form = parse_pairs(self.content, "&")
+        elif content_type == "multipart/form-data" and params.get("boundary"):
+            self._form, self._files = parse_multipart(self.stream, params['boundary'],
+                    spool_threshold=self.spool_threshold)
+
+    @property
+    def form(self):
+        if self._form is None:
+            self._parse_form()
+        return self._form
+
+    @property
+    def files(self):
+        if self._files is None:
+            self._parse_form()
+        return self._files
+
+    def close(self):
+        if not isinstance(self.body, bytes):
+            self.body.close()
+        for upload in (self._files or {}).values():
+            upload.close()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+
+class RouteNode:
+    __slots__ = ("children", "param", "table", "mount")
+
+    def __init__(self):
+        self.children = {}
+        self.param = None
+        self.table = None
+        self.mount = None
+
+
+class CompiledRoutes:
+    __slots__ = ("static", "root")
+
+    def __init__(self):
+        self.static = {}
+        self.root = RouteNode()
+
+
+class Router:
+    def __init__(self):
+        self.routes = {}
+        self.aliases = {}
+        self._compiled = None
+
+    @staticmethod
+    def is_pattern(path):
+        return "{" in path or path.endswith("/*")
+
+    def add(self, methods, path, route):
+        if (table := self.routes.get(path)) is not None and any(m in table for m in methods):
+            return False
+        self.routes.setdefault(path, {}).update({method: route for method in methods})
+        self._compiled = None
+        return True
+
+    def alias(self, src_path, dst_path, inherit_methods=False):
+        self.aliases[src_path] = (dst_path, inherit_methods)
+        self._compiled = None
+
+    def remove(self, path):
+        if self.routes.pop(path, None) is None and self.aliases.pop(path, None) is None:
+            return False
+        self._compiled = None
+        return True
+
+    def resolve_alias(self, src_path, seen=()):
+        dst_path, inherit_methods = self.aliases[src_path]
+        if dst_path in seen or dst_path == src_path:
+            return None
+        elif dst_path in self.aliases:
+            dst_table = self.resolve_alias(dst_path, (*seen, src_path))
+        else:
+            dst_table = self.routes.get(dst_path)
+        if not dst_table:
+            return None
+        methods = dst_table if inherit_methods else self.routes.get(src_path, dst_table)
+        fallback = next(iter(dst_table.values()))
+        return {
+                method: {**dst_table.get(method, fallback), "origin": src_path,
+                    "methods_supported": list(methods)}
+                for method in methods
+                }
+
+    def compile(self):
+        compiled = CompiledRoutes()
+        tables = dict(self.routes)
+        for src_path in self.aliases:
+            if (table := self.resolve_alias(src_path)) is not None:
+                tables[src_path] = table
+        for path, table in tables.items():
+            if not self.is_pattern(path):
+                compiled.static[path] = table
+                continue
+            segments = path.split("/")[1:]
+            if (mount := segments[-1] == "*"):
+                segments.pop()
+            node, names = compiled.root, []
+            for segment in segments:
+                if segment.startswith("{") and segment.endswith("}"):
+                    names.append(segment[1:-1])
+                    node.param = node.param or RouteNode()
+                    node = node.param
+                else:
+                    node = node.children.setdefault(segment, RouteNode())
+            if mount:
+                node.mount = (table, names)
+            else:
+                node.table = (table, names)
+        self._compiled = compiled
+        return compiled
+
+    def match(self, path, *, prefix=True):
+        compiled = self._compiled or self.compile()
+        if (table := compiled.static.get(path)) is not None:
+            return table, {}
+        node, values, mount = compiled.root, [], None
+        # one step per segment: literal children win over parameters and
+        # there is no backtracking, with the deepest mount as the fallback
+        for segment in path.split("/")[1:]:
+            if node.mount is not None:
+                mount = (node.mount, len(values))
+            if (child := node.children.get(segment)) is not None:
+                node = child
+            elif node.param is not None and segment:
+                values.append(segment)
+                node = node.param
+            else:
+                break
+        else:
+            if node.table is not None:
+                table, names = node.table
+                return table, dict(zip(names, values))
+            elif node.mount is not None:
+                mount = (node.mount, len(values))
+        if mount is None or not prefix:
+            return None, {}
+        (table, names), depth = mount
+        return table, dict(zip(names, values[:depth]))
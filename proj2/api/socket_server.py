@@ -1,49 +1,291 @@
 #!/usr/bin/env python3
-from io import StringIO, FileIO
+from .access_log import AccessLog
+from collections import deque
+import os
+import selectors
 import socket
-import sys
+import threading
+import time
+
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 16
+
+
+def send_buffers(conn, buffers):
+    if not hasattr(conn, "sendmsg"):
+        return conn.sendall(b"".join(buffers))
+    buffers = [memoryview(buf) for buf in buffers if buf]
+    index = 0
+    while index < len(buffers):
+        sent = conn.sendmsg(buffers[index:index + IOV_MAX])
+        while sent:  # drop what the kernel took, resume mid-buffer if short
+            if sent >= len(buffers[index]):
+                sent -= len(buffers[index])
+                index += 1
+            else:
+                buffers[index] = buffers[index][sent:]
+                sent = 0
+
+
+class ReactorConnection:
+    def __init__(self, server, conn, addr):
+        self.server = server
+        self.conn = conn
+        self.addr = addr
+        self.rbuf = bytearray()
+        self.wbuf = bytearray()
+        self.state = None
+        self.paused = False
+        self.closing = False
+        self.detached = False
+        self.on_drain = None
+        self.last_active = time.monotonic()
+        self._resume = False
+        self._detach_event = None
+        self._lock = threading.Lock()
+
+    def write(self, data, *, close=False, on_drain=None):
+        # on_drain runs (on the reactor thread) once everything buffered so
+        # far has reached the socket, which lets a writer produce the next
+        # piece only as fast as the client reads
+        with self._lock:
+            if data.__class__ is list:
+                for buf in data:
+                    self.wbuf += buf
+            else:
+                self.wbuf += data
+            self.closing = self.closing or close
+            if on_drain is not None:
+                self.on_drain = on_drain
+        self.server._reactor_wake(self)
+
+    def close(self):
+        self.write(b"", close=True)
+
+    def pause(self):
+        self.paused = True
+        self.server._reactor_wake(self)
+
+    def resume(self):
+        self.paused = False
+        self._resume = True
+        self.server._reactor_wake(self)
+
+    def detach(self):
+        self.detached = True
+        if threading.current_thread() is self.server._reactor_thread:
+            self.server._reactor_release(self)
+        else:
+            self._detach_event = threading.Event()
+            self.server._reactor_wake(self)
+            self._detach_event.wait()
+        self.conn.setblocking(True)
+        return self.conn
 
 
 class SocketServer:
-    def __init__(self, host, port, *, logger_file=None):
-        self.logger_file = logger_file
-        if logger_file is not None:
-            self.logger = StringIO()
-            sys.stdout = self.logger
+    ACCEPT_BACKOFF = 0.5
 
+    def __init__(self, host, port, *, logger_file=None, log_options=None, reuse_port=False):
+        self.logger_file = logger_file
+        self.logger = AccessLog(logger_file, **(log_options or {}))
         self.host = host
         self.port = port
+        self.reuse_port = reuse_port
+        self.socket = self.bind_socket()
+        self.log(f"[SocketServer] [{host}:{port}] successfully bound")
 
-        self.socket = socket.socket()
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.bind((host, port))
-        print(f"[SocketServer] [{host}:{port}] successfully bound")
+    def log(self, message):
+        return self.logger.log(message)
 
-    def handle_raw_connection(self, handler, *, buff_size=1, timeout=None):
-        self.socket.listen(1)
+    def bind_socket(self):
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        return sock
+
+    def handle_raw_connection(self, handler, *, buff_size=1, timeout=None, backlog=1):
+        self.socket.listen(backlog)
         self.socket.settimeout(timeout)
         while True:
             try:
                 conn, addr = self.socket.accept()
                 break        
             except KeyboardInterrupt:
-                print(f"[SocketServer] [{self.host}:{self.port}] received keyboard interrupt, exiting...")
+                self.log(f"[SocketServer] [{self.host}:{self.port}] received keyboard interrupt, exiting...")
                 return False
             except socket.timeout:
                 continue
-        print(f"[SocketServer] [{self.host}:{self.port}] received connection from {addr[0]}:{addr[1]}")
+        self.log(f"[SocketServer] [{self.host}:{self.port}] received connection from {addr[0]}:{addr[1]}")
         return handler(conn, addr)
-    
+
+    def _reactor_wake(self, rconn):
+        self._reactor_pending.append(rconn)
+        if threading.current_thread() is self._reactor_thread:
+            return
+        try:
+            self._reactor_waker[1].send(b"\0")
+        except BlockingIOError:
+            pass
+
+    def _reactor_interest(self, rconn):
+        events = (0 if rconn.paused else selectors.EVENT_READ) \
+                | (selectors.EVENT_WRITE if rconn.wbuf else 0)
+        registered = rconn.conn in self._selector.get_map()
+        if not events and registered:
+            self._selector.unregister(rconn.conn)
+        elif events and not registered:
+            self._selector.register(rconn.conn, events, rconn)
+        elif events and self._selector.get_key(rconn.conn).events != events:
+            self._selector.modify(rconn.conn, events, rconn)
+
+    def _reactor_release(self, rconn):
+        if rconn.conn in self._selector.get_map():
+            self._selector.unregister(rconn.conn)
+        self._reactor_conns.pop(rconn.conn, None)
+
+    def _reactor_close(self, rconn):
+        self._reactor_release(rconn)
+        rconn.conn.close()
+        rconn.closing = True
+        if (drained := rconn.on_drain) is not None:  # let the writer clean up
+            rconn.on_drain = None
+            drained()
+
+    def _reactor_accept(self):
+        while True:
+            try:
+                conn, addr = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:  # e.g. EMFILE or ECONNABORTED
+                self.log(f"[SocketServer] [{self.host}:{self.port}] accept failed: {exc}")
+                # the listener stays readable, so stop watching it for a
+                # moment rather than spinning on the same error
+                self._selector.unregister(self.socket)
+                self._reactor_accept_retry = time.monotonic() + SocketServer.ACCEPT_BACKOFF
+                return
+            conn.setblocking(False)
+            self._reactor_conns[conn] = (rconn := ReactorConnection(self, conn, addr))
+            self._selector.register(conn, selectors.EVENT_READ, rconn)
+
+    def _reactor_read(self, rconn, on_data, chunk_size):
+        try:
+            data = rconn.conn.recv(chunk_size)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            return self._reactor_close(rconn)
+        rconn.rbuf += data
+        rconn.last_active = time.monotonic()
+        on_data(rconn)
+
+    def _reactor_write(self, rconn):
+        with rconn._lock:
+            try:
+                sent = rconn.conn.send(rconn.wbuf)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                rconn.wbuf.clear()
+                rconn.closing = True
+                sent = 0
+            del rconn.wbuf[:sent]
+            done = not rconn.wbuf and rconn.closing
+            drained = None
+            if not rconn.wbuf and not done:
+                drained, rconn.on_drain = rconn.on_drain, None
+        rconn.last_active = time.monotonic()
+        if done:
+            return self._reactor_close(rconn)
+        elif drained is not None:
+            drained()
+        self._reactor_interest(rconn)
+
+    def _reactor_process_pending(self, on_data):
+        while self._reactor_pending:
+            rconn = self._reactor_pending.popleft()
+            if rconn.conn not in self._reactor_conns:
+                if rconn._detach_event is not None:
+                    rconn._detach_event.set()
+                continue
+            elif rconn.detached:
+                self._reactor_release(rconn)
+                rconn._detach_event.set()
+            elif rconn.wbuf:
+                self._reactor_write(rconn)
+            elif rconn.closing:
+                self._reactor_close(rconn)
+                continue
+            else:
+                self._reactor_interest(rconn)
+            if rconn._resume and not rconn.paused and not rconn.detached:
+                rconn._resume = False
+                on_data(rconn)
+
+    def handle_reactor_connections(self, on_data, *, backlog=128, timeout=1,
+            chunk_size=65536, idle_timeout=None):
+        self._selector = selectors.DefaultSelector()
+        self._reactor_thread = threading.current_thread()
+        self._reactor_conns = {}
+        self._reactor_pending = deque()
+        self._reactor_waker = socket.socketpair()
+        self._reactor_accept_retry = None
+        swept = time.monotonic()
+        for sock in self._reactor_waker:
+            sock.setblocking(False)
+        self.socket.listen(backlog)
+        self.socket.setblocking(False)
+        self._selector.register(self.socket, selectors.EVENT_READ, "accept")
+        self._selector.register(self._reactor_waker[0], selectors.EVENT_READ, "wake")
+        self.log(f"[SocketServer] [{self.host}:{self.port}] reactor listening ({type(self._selector).__name__})")
+        try:
+            while True:
+                if self._reactor_accept_retry is not None \
+                        and time.monotonic() >= self._reactor_accept_retry:
+                    self._reactor_accept_retry = None
+                    self._selector.register(self.socket, selectors.EVENT_READ, "accept")
+                for key, mask in self._selector.select(timeout if self._reactor_accept_retry is None
+                        else min(timeout, SocketServer.ACCEPT_BACKOFF)):
+                    if key.data == "accept":
+                        self._reactor_accept()
+                    elif key.data == "wake":
+                        try:
+                            while self._reactor_waker[0].recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    else:
+                        if mask & selectors.EVENT_WRITE:
+                            self._reactor_write(key.data)
+                        if mask & selectors.EVENT_READ and key.data.conn in self._reactor_conns:
+                            self._reactor_read(key.data, on_data, chunk_size)
+                self._reactor_process_pending(on_data)
+                # a sweep walks every connection, so it runs once per tick
+                # rather than after every wakeup
+                if idle_timeout is not None and time.monotonic() - swept >= timeout:
+                    swept = time.monotonic()
+                    deadline = swept - idle_timeout
+                    for rconn in [
+                            rconn for rconn in self._reactor_conns.values()
+                            if rconn.last_active < deadline and not rconn.paused and not rconn.wbuf
+                            ]:
+                        self._reactor_close(rconn)
+        except KeyboardInterrupt:
+            self.log(f"[SocketServer] [{self.host}:{self.port}] received keyboard interrupt, exiting...")
+        for rconn in list(self._reactor_conns.values()):
+            self._reactor_close(rconn)
+        self._selector.close()
+        for sock in self._reactor_waker:
+            sock.close()
+        return False
+
     def __del__(self):
-        if self.logger_file is not None:
-            sys.stdout = sys.__stdout__
-            self.logger.seek(0)
-            log = FileIO(self.logger_file, "w")  # odd behaviour at
-                                                 # deconstruction
-                                                 # prohibits open(...)
-            log.write(self.logger.read().encode())
-            log.close()
-            print(f"written logs to {self.logger_file!r}, exiting ...")
+        if (logger := getattr(self, "logger", None)) is not None:
+            logger.close()
 
 
 if __name__ == "__main__":
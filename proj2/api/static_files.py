@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+import mimetypes
+import os
+import re
+import stat
+import threading
+
+
+class StaticFiles:
+    FINGERPRINT = re.compile(r"\.[0-9a-f]{8,}\.[^./]+$")
+    TEXT_TYPES = ("application/javascript", "application/json", "image/svg+xml")
+
+    def __init__(self, root_dir, *, max_age=0, immutable_max_age=31536000,
+            fingerprint=FINGERPRINT, compression=None,
+            precompress_max_file=4 * 1024 * 1024, precompress_max_size=16 * 1024 * 1024):
+        self.root_dir = os.path.realpath(root_dir)
+        self.max_age = max_age
+        self.immutable_max_age = immutable_max_age
+        self.fingerprint = fingerprint
+        self.compression = compression
+        self.precompress_max_file = precompress_max_file
+        self.precompress_max_size = precompress_max_size
+        self.precompressed = OrderedDict()
+        self.precompressed_size = 0
+        self._lock = threading.Lock()
+
+    def resolve(self, path):
+        full = os.path.realpath(os.path.join(self.root_dir, path.lstrip("/")))
+        if not full.startswith(self.root_dir + os.sep):
+            return None
+        return full
+
+    def content_type(self, path):
+        ctype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if ctype.startswith("text/") or ctype in StaticFiles.TEXT_TYPES:
+            ctype += "; charset=utf-8"
+        return ctype
+
+    def cache_control(self, path):
+        if self.fingerprint is not None and self.fingerprint.search(path):
+            return f"public, max-age={self.immutable_max_age}, immutable"
+        elif self.max_age:
+            return f"public, max-age={self.max_age}"
+        return "no-cache"
+
+    @staticmethod
+    def etag(st):
+        return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+    @staticmethod
+    def not_modified(request, etag, mtime):
+        if (if_none_match := request.get("If-None-Match")) is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or etag in tags
+        elif (if_modified_since := request.get("If-Modified-Since")) is not None:
+            try:
+                return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def negotiate(self, request, full, st):
+        if self.compression is None or not self.compression.compressible(self.content_type(full)) \
+                or not self.compression.min_size <= st.st_size <= self.precompress_max_file:
+            return None, False
+        return self.compression.negotiate(request.get("Accept-Encoding")), True
+
+    def precompress(self, full, file, st, encoding):
+        stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            if (entry := self.precompressed.get((full, encoding))) is not None \
+                    and entry[0] == stamp:
+                self.precompressed.move_to_end((full, encoding))
+                return entry[1]
+        data = self.compression.compress(encoding, file.read(st.st_size),
+                self.compression.static_level)
+        with self._lock:
+            if (old := self.precompressed.pop((full, encoding), None)) is not None:
+                self.precompressed_size -= len(old[1])
+            self.precompressed[full, encoding] = (stamp, data)
+            self.precompressed_size += len(data)
+            while self.precompressed_size > self.precompress_max_size:
+                self.precompressed_size -= len(self.precompressed.popitem(last=False)[1][1])
+        return data
+
+    def serve(self, conn, path):
+        if (full := self.resolve(path)) is None:
+            return False
+        try:
+            file = open(full, "rb")
+        except OSError:
+            return False
+        if not stat.S_ISREG((st := os.fstat(file.fileno())).st_mode):
+            file.close()
+            return False
+        request = getattr(conn, "request", None) or {}
+        encoding, vary = self.negotiate(request, full, st)
+        etag = self.etag(st)
+        if encoding is not None:
+            etag = f'{etag[:-1]}-{encoding}"'
+        headers = (
+                f"ETag: {etag}\r\n"
+                f"Last-Modified: {formatdate(st.st_mtime, usegmt=True)}\r\n"
+                f"Cache-Control: {self.cache_control(full)}\r\n"
+                + ("Vary: Accept-Encoding\r\n" if vary else "")
+                )
+        if self.not_modified(request, etag, st.st_mtime):
+            file.close()
+            conn.send(f"HTTP/1.1 304 Not Modified\r\n{headers}\r\n".encode())
+            return True
+        if encoding is not None:
+            with file:
+                data = self.precompress(full, file, st, encoding)
+            conn.send((
+                    "HTTP/1.1 200 OK\r\n"
+                    f"Content-Type: {self.content_type(full)}\r\n"
+                    f"Content-Encoding: {encoding}\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"{headers}\r\n"
+                    ).encode())
+            conn.send(data)
+            return True
+        head = (
+                "HTTP/1.1 200 OK\r\n"
+                f"Content-Type: {self.content_type(full)}\r\n"
+                f"{headers}\r\n"
+                ).encode()
+        if hasattr(conn, "send_file"):
+            conn.send_file(head, file, st.st_size)
+        else:
+            with file:
+                conn.send(head + file.read())
+        return True
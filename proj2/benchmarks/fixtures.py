@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+
+ROLES = {
+    "guest": {"color": "#fff", "background-color": "#006e98"},
+    "member": {"color": "#fff", "background-color": "cadetblue"},
+    "admin": {"color": "#fff", "background-color": "brown"}
+    }
+# webserver.py adds these itself; generating them here keeps their sids stable
+BUILTIN_SECTIONS = (
+    ("Public", ["guest", "member", "admin"]),
+    ("Lounge", ["member", "admin"]),
+    ("Admin-Only", ["admin"])
+    )
+WORDS = ("lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit",
+         "sed", "do", "eiusmod", "tempor", "incididunt", "ut", "labore", "et", "dolore",
+         "magna", "aliqua", "forum", "thread", "reply", "server", "socket", "python")
+
+
+def token(username, password):
+    return hashlib.sha256(f"{username}:{password}".encode()).hexdigest()
+
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def user_properties(uid, role):
+    return {
+        "uid": uid,
+        "role": role,
+        "threads": 0,
+        "threads_ref": [],
+        "posts": 0,
+        "posts_ref": [],
+        "reputation": 0,
+        "reputation_content": {},
+        "ip": "127.0.0.1",
+        "biography": "",
+        "inbox": []
+        }
+
+
+def generate(target_dir, *, users=100, sections=3, threads=20, replies=10, pms=5, seed=0):
+    rng = random.Random(seed)
+    database = {
+        "Admin": (token("Admin", ""), user_properties(1, "admin")),
+        "Guest": (token("Guest", ""), user_properties(2, "guest"))
+        }
+    members = []
+    for idx in range(users):
+        name = f"user{idx}"
+        database[name] = (token(name, (password := f"password{idx}")), user_properties(idx + 3, "member"))
+        members.append({"username": name, "password": password, "uid": idx + 3})
+
+    forum_dir = os.path.join(target_dir, "forum")
+    shutil.rmtree(forum_dir, ignore_errors=True)
+    os.makedirs(forum_dir)
+    with open(os.path.join(forum_dir, "roles.json"), "w") as roles:
+        json.dump(ROLES, roles, indent=2)
+    layout = list(BUILTIN_SECTIONS) + [
+            (f"Section-{idx}", ["guest", "member", "admin"])
+            for idx in range(max(0, sections - len(BUILTIN_SECTIONS)))
+            ]
+    authors = list(database)
+    for name, allowed_roles in layout:
+        os.mkdir(section_dir := os.path.join(forum_dir, name))
+        with open(os.path.join(section_dir, "allowed_roles.json"), "w") as roles:
+            json.dump(allowed_roles, roles)
+        for tid in range(1, threads + 1):
+            os.mkdir(thread_dir := os.path.join(section_dir, str(tid)))
+            author = rng.choice(authors)
+            database[author][1]['threads'] += 1
+            with open(os.path.join(thread_dir, "info"), "w") as info:
+                json.dump({
+                    "tid": tid,
+                    "uid": database[author][1]['uid'],
+                    "ip": "127.0.0.1",
+                    "username": author,
+                    "title": sentence(rng, 5),
+                    "content": sentence(rng, 60)
+                    }, info)
+            for pid in range(1, replies + 1):
+                author = rng.choice(authors)
+                database[author][1]['posts'] += 1
+                with open(os.path.join(thread_dir, f"{pid}.reply"), "w") as reply:
+                    json.dump({
+                        "pid": pid,
+                        "ip": "127.0.0.1",
+                        "uid": database[author][1]['uid'],
+                        "username": author,
+                        "content": sentence(rng, 40)
+                        }, reply)
+
+    for member in members if len(members) > 1 else ():
+        inbox = database[member['username']][1]['inbox']
+        for _ in range(pms):
+            other = rng.choice(members)['username']
+            title, content = sentence(rng, 4), sentence(rng, 30)
+            inbox.append({"id": len(inbox) + 1, "from": other, "title": title,
+                          "content": content, "type": "received"})
+            sent = database[other][1]['inbox']
+            sent.append({"id": len(sent) + 1, "to": member['username'], "title": title,
+                         "content": content, "type": "sent"})
+
+    with open(os.path.join(target_dir, "login.db"), "w") as db:
+        json.dump(database, db, indent=2)
+
+    # Forum numbers sections by their position in os.listdir(), roles.json included
+    sids = {name: idx for idx, name in enumerate(os.listdir(forum_dir)) if name != "roles.json"}
+    return {
+        "members": members,
+        "sections": [
+            {"name": name, "sid": sids[name], "threads": threads, "allowed_roles": allowed_roles}
+            for name, allowed_roles in layout
+            ]
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="generate a synthetic login.db and forum/ tree")
+    parser.add_argument("target_dir")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--sections", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=20, help="threads per section")
+    parser.add_argument("--replies", type=int, default=10, help="replies per thread")
+    parser.add_argument("--pms", type=int, default=5, help="received PMs per user")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    manifest = generate(args.target_dir, users=args.users, sections=args.sections,
+            threads=args.threads, replies=args.replies, pms=args.pms, seed=args.seed)
+    print(json.dumps({"users": len(manifest['members']), "sections": manifest['sections']}))
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+from .fixtures import generate
+from urllib.parse import urlencode
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT_FILES = ("webserver.py", "utils.py", "database.py", "forum.py", "api", "www")
+
+if PROJECT_DIR not in sys.path:
+    sys.path.insert(0, PROJECT_DIR)
+
+DEFAULT_MIX = {
+    "index": 20,
+    "section": 15,
+    "thread": 30,
+    "profile": 10,
+    "member_list": 5,
+    "inbox": 5,
+    "login": 10,
+    "post": 5
+    }
+
+
+def percentile(ordered, pct):
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]  # nearest rank
+
+
+def summarise(latencies):
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3) if ordered else None,
+        **{f"p{pct}_ms": None if (value := percentile(ordered, pct)) is None else round(value * 1000, 3)
+           for pct in (50, 95, 99)},
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else None
+        }
+
+
+class Client:
+    def __init__(self, port, manifest, mix, rng):
+        self.port = port
+        self.manifest = manifest
+        self.operations, self.weights = zip(*mix.items())
+        self.rng = rng
+        self.member = rng.choice(manifest['members'])
+        self.cookie = None
+        self.conn = None
+
+    def request(self, method, path, body=None):
+        headers = {"Cookie": f"token={self.cookie}"} if self.cookie else {}
+        if body is not None:
+            body = urlencode(body)
+            headers['Content-Type'] = "application/x-www-form-urlencoded"
+        for attempt in range(2):  # the server may close an idle keep-alive connection
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+            try:
+                self.conn.request(method, path, body, headers)
+                response = self.conn.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+                continue
+            if response.getheader("Connection", "").lower() == "close":
+                self.conn.close()
+                self.conn = None
+            return response
+        return None
+
+    def section(self):
+        role = "guest" if self.cookie is None else "member"
+        return self.rng.choice([
+                section for section in self.manifest['sections']
+                if role in section['allowed_roles'] and section['threads']
+                ])
+
+    def thread_path(self):
+        section = self.section()
+        return section['sid'], self.rng.randint(1, section['threads'])
+
+    def run(self, operation):
+        if operation == "index":
+            return self.request("GET", "/index")
+        elif operation == "section":
+            return self.request("GET", f"/index?sid={self.section()['sid']}")
+        elif operation == "thread":
+            sid, tid = self.thread_path()
+            return self.request("GET", f"/index?sid={sid}&tid={tid}")
+        elif operation == "profile":
+            return self.request("GET", f"/profile?uid={self.rng.choice(self.manifest['members'])['uid']}")
+        elif operation == "member_list":
+            return self.request("GET", "/member-list")
+        elif operation == "inbox":
+            return self.request("GET", "/inbox")
+        elif operation == "login":
+            self.cookie = None
+            response = self.request("POST", "/login", {
+                "username": self.member['username'], "password": self.member['password']
+                })
+            if (cookie := response.getheader("Set-Cookie", "")).startswith("token="):
+                self.cookie = cookie.partition("=")[2].partition(";")[0]
+            return response
+        elif operation == "post":
+            sid, tid = self.thread_path()
+            return self.request("POST", f"/index?sid={sid}&tid={tid}", {
+                "action": "make_reply", "post": f"benchmark reply {self.rng.random()}"
+                })
+        raise ValueError(f"unknown operation {operation!r}")
+
+    def next_operation(self):
+        # posting and the inbox need a session, so the first of either logs in
+        if (operation := self.rng.choices(self.operations, self.weights)[0]) in ("post", "inbox") \
+                and self.cookie is None:
+            return "login"
+        return operation
+
+
+def drive(port, manifest, mix, *, clients, duration, requests, seed):
+    results = {operation: [] for operation in mix}
+    statuses, errors = {}, {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration if duration else None
+    remaining = [requests]
+
+    def take():
+        if deadline is not None:
+            return time.perf_counter() < deadline
+        with lock:
+            remaining[0] -= 1
+            return remaining[0] >= 0
+
+    def worker(idx):
+        client = Client(port, manifest, mix, random.Random(seed * 1000 + idx))
+        latencies = {operation: [] for operation in mix}
+        while take():
+            operation = client.next_operation()
+            started = time.perf_counter()
+            try:
+                response = client.run(operation)
+            except (OSError, http.client.HTTPException) as exc:
+                with lock:
+                    errors[type(exc).__name__] = errors.get(type(exc).__name__, 0) + 1
+                continue
+            latencies[operation].append(time.perf_counter() - started)
+            with lock:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+        if client.conn is not None:
+            client.conn.close()
+        with lock:
+            for operation, values in latencies.items():
+                results[operation].extend(values)
+
+    threads = [threading.Thread(target=worker, args=(idx,)) for idx in range(clients)]
+    started = time.perf_counter()
+    for thd in threads:
+        thd.start()
+    for thd in threads:
+        thd.join()
+    elapsed = time.perf_counter() - started
+    everything = [value for values in results.values() for value in values]
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "requests": len(everything),
+        "throughput_rps": round(len(everything) / elapsed, 1),
+        "latency": summarise(everything),
+        "operations": {operation: summarise(values) for operation, values in results.items() if values},
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "errors": errors
+        }
+
+
+def compare(report, baseline):
+    def change(new, old):
+        return None if not old or new is None else round((new - old) / old * 100, 1)
+
+    return {
+        "throughput_rps_pct": change(report['throughput_rps'], baseline['throughput_rps']),
+        **{f"{key}_pct": change(report['latency'][key], baseline['latency'][key])
+           for key in ("p50_ms", "p95_ms", "p99_ms")}
+        }
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"webserver.py exited with status {process.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"webserver.py did not listen on port {port} within {timeout}s")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="end-to-end load benchmark for webserver.py")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--sections", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=50, help="threads per section")
+    parser.add_argument("--replies", type=int, default=20, help="replies per thread")
+    parser.add_argument("--pms", type=int, default=10, help="received PMs per user")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run for")
+    parser.add_argument("--requests", type=int, default=0,
+            help="stop after this many requests instead of after --duration")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds of unmeasured traffic first")
+    parser.add_argument("--mix", type=json.loads, default=DEFAULT_MIX,
+            help="JSON object of operation weights")
+    parser.add_argument("--config", type=json.loads, default={},
+            help="JSON merged into config.json, e.g. '{\"mode\": \"reactor\", \"workers\": 4}'")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary server directory")
+    args = parser.parse_args(argv)
+    if unknown := set(args.mix) - set(DEFAULT_MIX):
+        parser.error(f"unknown operations in --mix: {', '.join(sorted(unknown))}")
+
+    work_dir = tempfile.mkdtemp(prefix="proj2-bench-")
+    for name in PROJECT_FILES:
+        src = os.path.join(PROJECT_DIR, name)
+        if os.path.isdir(src):
+            shutil.copytree(src, os.path.join(work_dir, name),
+                    ignore=shutil.ignore_patterns("__pycache__"))
+        else:
+            shutil.copy(src, work_dir)
+    fixture = {"users": args.users, "sections": args.sections, "threads": args.threads,
+               "replies": args.replies, "pms": args.pms, "seed": args.seed}
+    manifest = generate(work_dir, **fixture)
+    if (engine := args.config.get("database_engine", "json")) != "json":
+        from database import migrate
+        os.replace((database := os.path.join(work_dir, "login.db")), f"{database}.json")
+        migrate(f"{database}.json", database, target_engine=engine)
+    port = args.port or free_port()
+    with open(os.path.join(work_dir, "config.json"), "w") as config:
+        json.dump({"host": "127.0.0.1", "port": str(port), "root_dir": "www/",
+                   "logger_file": "access.log", "database_file": "login.db", **args.config}, config)
+    process = subprocess.Popen([sys.executable, "webserver.py"], cwd=work_dir,
+            stdout=open(os.path.join(work_dir, "server.out"), "w"), stderr=subprocess.STDOUT)
+    try:
+        wait_for_port(port, process)
+        if args.warmup:
+            drive(port, manifest, args.mix, clients=args.clients, duration=args.warmup,
+                    requests=0, seed=args.seed + 1)
+        report = drive(port, manifest, args.mix, clients=args.clients,
+                duration=0 if args.requests else args.duration,
+                requests=args.requests, seed=args.seed)
+    finally:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    report = {"fixture": fixture, "clients": args.clients, "config": args.config, **report}
+    if args.keep:
+        report['work_dir'] = work_dir
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            report['baseline'] = compare(report, json.load(baseline))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+from functools import partial
+import argparse
+import importlib
+import json
+import os
+import sys
+import timeit
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJ1_DIR = os.path.join(os.path.dirname(PROJECT_DIR), "proj1")
+DEFAULT_BASELINE = os.path.join(PROJECT_DIR, "benchmarks", "baseline.json")
+
+if PROJECT_DIR not in sys.path:
+    sys.path.insert(0, PROJECT_DIR)
+
+RAW_REQUEST = (
+    "GET /index?sid=1&tid=12 HTTP/1.1\r\n"
+    "Host: 127.0.0.1:6969\r\n"
+    "User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0\r\n"
+    "Accept: text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8\r\n"
+    "Accept-Language: en-GB,en;q=0.5\r\n"
+    "Accept-Encoding: gzip, deflate, br\r\n"
+    "Referer: http://127.0.0.1:6969/index?sid=1\r\n"
+    "Connection: keep-alive\r\n"
+    "Cookie: token=3f2b8e0c4a5d6e7f8a9b0c1d2e3f4a5b6c7d8e9f0a1b2c3d4e5f6a7b8c9d0e1f; theme=dark\r\n"
+    "Upgrade-Insecure-Requests: 1\r\n"
+    "\r\n"
+    )
+ROUTES = ("/", "/index", "/thread/{sid}/{tid}", "/login", "/register", "/logout", "/make-thread",
+          "/member-list", "/profile", "/about", "/profile_action", "/inbox", "/chat",
+          "/404", "/403", "/400", "/405", "/*")
+
+
+def load_proj1():
+    # proj1 and proj2 both call their package "api", so import proj1's under
+    # a clean slate and put proj2's modules back afterwards
+    is_api = lambda name: name == "api" or name.startswith("api.")
+    saved = {name: sys.modules.pop(name) for name in list(sys.modules) if is_api(name)}
+    sys.path.insert(0, PROJ1_DIR)
+    try:
+        return importlib.import_module("api.http_server")
+    finally:
+        sys.path.remove(PROJ1_DIR)
+        for name in [name for name in sys.modules if is_api(name)]:
+            del sys.modules[name]
+        sys.modules.update(saved)
+
+
+class FrameSource:
+    def __init__(self, frame):
+        self.frame = frame
+        self.offset = 0
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv(self, size):
+        data = self.frame[self.offset:self.offset + size]
+        self.offset += size
+        return data
+
+
+def masked_frame(text, key=b"\x12\x34\x56\x78"):
+    payload = bytes(byte ^ key[idx % 4] for idx, byte in enumerate(text.encode()))
+    if len(payload) <= 125:
+        length = bytes((0x80 | len(payload),))
+    else:
+        length = bytes((0x80 | 126,)) + len(payload).to_bytes(2, "big")
+    return b"\x81" + length + key + payload
+
+
+def build_benchmarks():
+    from api.http_server import HttpServer
+    import utils
+
+    construct = partial(utils.construct_http_response, HttpServer.SUPPORTED_HTTP_VERSION)
+    with open(os.path.join(PROJECT_DIR, "www", "index.html")) as index:
+        index_html = index.read()
+    body = "\n".join(f"<li><a href='/index?sid=1&tid={tid}'>Thread {tid}</a></li>" for tid in range(40))
+    page = utils.determine_template(index_html, "user1", forum_title="Forum", body=body)
+
+    server = HttpServer(PROJECT_DIR, "127.0.0.1", 0, logger_file=os.devnull)
+    for path in ROUTES:
+        server.add_route(["GET", "POST"], path, lambda *args: None)
+    raw = RAW_REQUEST.encode()
+    request = HttpServer.parse_http_request(raw)
+    thread_request = HttpServer.parse_http_request(raw.replace(b"/index?sid=1&tid=12", b"/thread/1/12"))
+    static_request = HttpServer.parse_http_request(raw.replace(b"/index?sid=1&tid=12", b"/index.css"))
+
+    def parse_with_headers():
+        parsed = HttpServer.parse_http_request(raw)
+        return parsed.headers, parsed.cookies, parsed.query
+
+    def dispatch(request):
+        return server.get_route(None, ("127.0.0.1", 40000), request.method, request.uri,
+                request=request)
+
+    def decode(frame):
+        return utils.decode_websocket(FrameSource(frame))
+
+    proj1 = load_proj1()
+    proj1_response = {"http_version": "HTTP/1.1", "status_code": 200, "reason_phrase": "OK",
+                      "headers": {"Content-Type": "text/html", "Set-Cookie": "token=abc",
+                                  "Connection": "keep-alive"}}
+
+    return {
+        "proj2.parse_http_request": partial(HttpServer.parse_http_request, raw),
+        "proj2.parse_http_request+headers": parse_with_headers,
+        "proj2.get_route.literal": partial(dispatch, request),
+        "proj2.get_route.param": partial(dispatch, thread_request),
+        "proj2.get_route.mount": partial(dispatch, static_request),
+        "utils.construct_http_response": partial(construct, 200, "OK",
+                {"Content-Type": "text/html", "Set-Cookie": "token=abc"}, page),
+        "utils.determine_template.member": partial(utils.determine_template, index_html, "user1",
+                forum_title="Forum", body=body),
+        "utils.determine_template.guest": partial(utils.determine_template, index_html, "Guest",
+                forum_title="Forum", body=body),
+        "utils.encode_websocket.short": partial(utils.encode_websocket, "hello, world"),
+        "utils.encode_websocket.1k": partial(utils.encode_websocket, "x" * 1024),
+        "utils.decode_websocket.short": partial(decode, masked_frame("hello, world")),
+        "utils.decode_websocket.1k": partial(decode, masked_frame("x" * 1024)),
+        "proj1.parse_http_request": partial(proj1.parse_http_request, RAW_REQUEST),
+        "proj1.construct_http_response": partial(proj1.construct_http_response, proj1_response, page)
+        }
+
+
+def measure(fn, *, repeat=5, min_time=0.2):
+    timer = timeit.Timer(fn)
+    number = 1
+    while timer.timeit(number) < min_time:  # like Timer.autorange, to a chosen time
+        number *= 2
+    per_call = sorted(total / number * 1e9 for total in timer.repeat(repeat, number))
+    return {"ns_min": round(per_call[0], 1), "ns_median": round(per_call[len(per_call) // 2], 1),
+            "number": number}
+
+
+def compare(results, baseline, threshold):
+    regressions, changes = [], {}
+    for name, result in results.items():
+        if (old := baseline.get("results", {}).get(name)) is None:
+            continue
+        change = round((result['ns_min'] - old['ns_min']) / old['ns_min'] * 100, 1)
+        limit = baseline.get("thresholds", {}).get(name, threshold)
+        changes[name] = change
+        if change > limit:
+            regressions.append({"name": name, "change_pct": change, "threshold_pct": limit})
+    return changes, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="microbenchmarks for the protocol and rendering hot paths")
+    parser.add_argument("-k", "--filter", default="", help="only run benchmarks containing this text")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per timing run")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--threshold", type=float, default=10,
+            help="percent slowdown against the baseline that counts as a regression")
+    parser.add_argument("--save", action="store_true", help="record these results as the baseline")
+    parser.add_argument("--list", action="store_true")
+    args = parser.parse_args(argv)
+
+    benchmarks = build_benchmarks()
+    if args.list:
+        print("\n".join(benchmarks))
+        return 0
+    results = {
+        name: measure(fn, repeat=args.repeat, min_time=args.min_time)
+        for name, fn in benchmarks.items() if args.filter in name
+        }
+
+    report = {"python": sys.version.split()[0], "results": results}
+    baseline = None
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    if args.save:
+        if baseline is not None:  # keep per-benchmark thresholds and unselected results
+            results = {**baseline.get("results", {}), **results}
+            report = {**baseline, **report, "results": results}
+        with open(args.baseline, "w") as file:
+            json.dump(report, file, indent=2)
+        print(json.dumps(report, indent=2))
+        return 0
+    regressions = []
+    if baseline is not None:
+        report['change_pct'], regressions = compare(results, baseline, args.threshold)
+        report['regressions'] = regressions
+    print(json.dumps(report, indent=2))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
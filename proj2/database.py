@@ -1,50 +1,579 @@
+from contextlib import contextmanager
+from functools import partial
+import argparse
+import atexit
+import fcntl
 import hashlib
 import json
 import os
+import sqlite3
+import threading
+import time
+import weakref
 
 
-class LoginDatabase:
+class JsonStorage:
     def __init__(self, filename):
         self.filename = filename
-        if os.path.isfile(filename):
-            with open(filename) as db:
-                self.database = json.load(db)
-        else:
-            with open(filename, "w") as db:
+
+    def stamp(self):
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            with open(self.filename, "w") as db:
                 db.write("{}")
-            self.database = {}
+            return {}
+        with open(self.filename) as db:
+            return json.load(db)
+
+    def save(self, database, usernames=None):
+        # a JSON document has no rows to update, so every save rewrites it
+        with open((tmp := f"{self.filename}.tmp"), "w") as db:
+            json.dump(database, db, indent=2)
+        os.replace(tmp, self.filename)
+
+
+class SqliteStorage:
+    # every save bumps meta.version and stamps the rows it writes (or the
+    # tombstones of those it deletes), so other workers can pull just those
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        username TEXT PRIMARY KEY,
+        token TEXT NOT NULL,
+        uid INTEGER,
+        role TEXT,
+        properties TEXT NOT NULL,
+        version INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS users_token ON users (token);
+    DROP INDEX IF EXISTS users_uid;
+    DROP INDEX IF EXISTS users_role;
+    CREATE TABLE IF NOT EXISTS removed (
+        username TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS removed_version ON removed (version);
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO meta VALUES ('version', 0);
+    """
+    VERSION = "SELECT value FROM meta WHERE key = 'version'"
+    SYNCHRONOUS = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+    def __init__(self, filename, *, synchronous="NORMAL", timeout=30):
+        if synchronous.upper() not in SqliteStorage.SYNCHRONOUS:
+            raise ValueError(f"unknown synchronous mode {synchronous!r}, expected one of {SqliteStorage.SYNCHRONOUS}")
+        self.filename = filename
+        self.synchronous = synchronous.upper()
+        self.timeout = timeout
+        self._conn = None
+        self._pid = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        if self._pid != os.getpid():
+            # a connection must not cross fork(), so each worker opens its own
+            self._conn = sqlite3.connect(self.filename, timeout=self.timeout,
+                    isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            self._conn.executescript(SqliteStorage.SCHEMA)
+            if "version" not in {column[1] for column in self._conn.execute("PRAGMA table_info(users)")}:
+                self._conn.execute("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS users_version ON users (version)")
+            self._pid = os.getpid()
+        return self._conn
+
+    def stamp(self):
+        # changes whenever another connection (i.e. another worker) commits;
+        # the count is per connection, so a forked worker's first one can
+        # repeat the parent's by chance, hence the pid
+        with self._lock:
+            return os.getpid(), self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def tail(self, old, new):
+        # the rows committed since this worker last looked, as
+        # (username, entry) pairs with None for a removed user
+        with self._lock:
+            if self._version is None:
+                return None
+            conn = self.conn
+            conn.execute("BEGIN")
+            try:
+                version = conn.execute(SqliteStorage.VERSION).fetchone()[0]
+                changed = conn.execute("SELECT username, token, properties FROM users WHERE version > ?",
+                        (self._version,)).fetchall()
+                removed = conn.execute("SELECT username FROM removed WHERE version > ?",
+                        (self._version,)).fetchall()
+            finally:
+                conn.execute("COMMIT")
+            self._version = version
+        return [(username, [token, json.loads(properties)]) for username, token, properties in changed] \
+                + [(username, None) for username, in removed]
+
+    def load(self):
+        with self._lock:
+            conn = self.conn
+            conn.execute("BEGIN")
+            try:
+                self._version = conn.execute(SqliteStorage.VERSION).fetchone()[0]
+                return {
+                    username: [token, json.loads(properties)]
+                    for username, token, properties in conn.execute(
+                        "SELECT username, token, properties FROM users")
+                    }
+            finally:
+                conn.execute("COMMIT")
+
+    @staticmethod
+    def row(username, entry):
+        token, properties = entry
+        return username, token, properties.get("uid"), properties.get("role"), json.dumps(properties)
+
+    def save(self, database, usernames=None):
+        with self._lock:
+            conn = self.conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+                version = conn.execute(SqliteStorage.VERSION).fetchone()[0]
+                if usernames is None:
+                    usernames = list(database)
+                    removed = {username for username, in conn.execute("SELECT username FROM users")} \
+                            - database.keys()
+                else:
+                    removed = [username for username in usernames if username not in database]
+                conn.executemany("DELETE FROM users WHERE username = ?",
+                        [(username,) for username in removed])
+                conn.executemany("INSERT OR REPLACE INTO removed VALUES (?, ?)",
+                        [(username, version) for username in removed])
+                conn.executemany("DELETE FROM removed WHERE username = ?",
+                        [(username,) for username in usernames if username in database])
+                conn.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?)", [
+                        self.row(username, database[username]) + (version,)
+                        for username in usernames if username in database
+                        ])
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            if self._version == version - 1:  # nobody else committed in between
+                self._version = version
+
+
+class JournalStorage:
+    FSYNC = ("always", "interval", "never")
+
+    def __init__(self, filename, *, fsync="interval", fsync_interval=1.0, compact_bytes=4 << 20,
+                 compact_interval=None):
+        if fsync not in JournalStorage.FSYNC:
+            raise ValueError(f"unknown fsync policy {fsync!r}, expected one of {JournalStorage.FSYNC}")
+        self.filename = filename
+        self.journal = f"{filename}.journal"
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.compact_bytes = compact_bytes
+        self.compact_interval = compact_interval
+        self._fd = None
+        self._gen = 0
+        self._size = 0
+        self._dirty = False
+        self._compacted = time.monotonic()
+        self._pid = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._compacting = threading.Lock()
+        # a fork() mid-compaction would hand each child the flocked sidecars,
+        # and a fork() mid-save a held _lock, with no thread left to release them
+        ref = weakref.ref(self)
+        os.register_at_fork(before=partial(JournalStorage._fork, ref, "before"),
+                            after_in_parent=partial(JournalStorage._fork, ref, "parent"),
+                            after_in_child=partial(JournalStorage._fork, ref, "child"))
+
+    @staticmethod
+    def _fork(ref, stage):
+        if (self := ref()) is None:
+            return
+        elif stage == "before":
+            self._compacting.acquire()
+            self._lock.acquire()
+        elif stage == "parent":
+            self._lock.release()
+            self._compacting.release()
+        else:
+            self._lock = threading.Lock()
+            self._compacting = threading.Lock()
+            self._wake = threading.Event()
+            self._pid = None  # restarts the fsync/compaction thread on the next save
+
+    def segment(self, gen):
+        return f"{self.journal}.{gen}"
+
+    def segments(self):
+        directory, prefix = os.path.split(self.journal)
+        prefix += "."
+        return sorted(
+                int(suffix) for name in os.listdir(directory or ".")
+                if name.startswith(prefix) and (suffix := name[len(prefix):]).isdigit()
+                )
+
+    @contextmanager
+    def _locked_file(self):
+        # the sidecar LoginDatabase.locked() holds around every write, so
+        # this must never be taken by a thread that is already inside it
+        with open(f"{self.filename}.lock", "a") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            yield
+
+    def stamp(self):
+        try:
+            stat = os.stat(self.filename)
+            sizes = []
+            for gen in self.segments():
+                with open(self.segment(gen), "rb") as segment:
+                    if (size := os.fstat(segment.fileno()).st_size) \
+                            and os.pread(segment.fileno(), 1, size - 1) != b"\n":
+                        size = -size  # another worker is mid-append; never equal to a clean stamp
+                sizes.append((gen, size))
+        except FileNotFoundError:  # raced a compaction; the next stamp will differ
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size, tuple(sizes)
+
+    def tail(self, old, new):
+        # what other workers appended since `old`, as long as nobody
+        # compacted in between
+        if old is None or new is None or old[:3] != new[:3] \
+                or any(size < 0 for _, size in old[3] + new[3]):
+            return None
+        seen = dict(old[3])
+        changes = []
+        try:
+            for gen, size in new[3]:
+                if size > (start := seen.get(gen, 0)):
+                    with open(self.segment(gen), "rb") as segment:
+                        segment.seek(start)
+                        changes.extend(self.records(segment.read(size - start)))
+        except FileNotFoundError:
+            return None
+        return changes
+
+    @staticmethod
+    def records(data):
+        for line in data.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:  # a write torn by a crash
+                continue
+            yield record['user'], record['entry'] if record['op'] == "put" else None
+
+    @staticmethod
+    def replay(database, data):
+        for username, entry in JournalStorage.records(data):
+            if entry is None:
+                database.pop(username, None)
+            else:
+                database[username] = entry
+        return database
+
+    def load(self, gens=None):
+        database = JsonStorage(self.filename).load()
+        for gen in self.segments() if gens is None else gens:
+            try:
+                with open(self.segment(gen), "rb") as segment:
+                    self.replay(database, segment.read())
+            except FileNotFoundError:
+                continue
+        return database
 
-    def write_changes(self):
-        with open(self.filename, "w") as db:
-            json.dump(self.database, db, indent=2)
+    def _open(self):
+        # runs under the write flock, so the newest segment is the live one;
+        # other workers' compactions may have moved past ours and unlinked it
+        if self._fd is not None and os.fstat(self._fd).st_nlink \
+                and not os.path.exists(self.segment(self._gen + 1)):
+            return
+        gen = max(self.segments(), default=self._gen)
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.segment(gen), os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self._gen = gen
+        if (size := os.fstat(self._fd).st_size) and os.pread(self._fd, 1, size - 1) != b"\n":
+            # drop a record torn by a crash so the next append starts on a fresh line
+            with open(self.segment(gen), "rb") as segment:
+                size = segment.read().rfind(b"\n") + 1
+            os.ftruncate(self._fd, size)
+        self._size = size
+
+    def _start(self):
+        if self._pid != os.getpid():  # threads don't survive fork()
+            threading.Thread(target=self._run, daemon=True).start()
+            self._pid = os.getpid()
+
+    def save(self, database, usernames=None):
+        with self._lock:
+            if usernames is None:
+                return self._rewrite(database)
+            self._open()
+            data = "".join(
+                    json.dumps({"op": "put", "user": username, "entry": database[username]}
+                               if username in database else {"op": "del", "user": username}) + "\n"
+                    for username in usernames
+                    ).encode()
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self._fd, view):]
+            self._size += len(data)
+            if self.fsync == "always":
+                os.fsync(self._fd)
+            elif self.fsync == "interval":
+                self._dirty = True
+            self._start()
+            if self._size >= self.compact_bytes:
+                self._wake.set()
+
+    def _rewrite(self, database):
+        # a full save is the in-memory state, so it becomes the snapshot;
+        # the caller already holds the write lock
+        gens = self.segments()
+        self.write_snapshot(database)
+        open(self.segment(max(gens, default=self._gen) + 1), "a").close()
+        for gen in gens:
+            os.remove(self.segment(gen))
+        self._open()
+
+    def write_snapshot(self, database):
+        with open((tmp := f"{self.filename}.tmp"), "w") as db:
+            json.dump(database, db, indent=2)
+            db.flush()
+            os.fsync(db.fileno())
+        os.replace(tmp, self.filename)
+        directory = os.open(os.path.dirname(self.filename) or ".", os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def compact(self):
+        with self._compacting, open(f"{self.filename}.compact", "a") as guard:
+            try:
+                fcntl.flock(guard, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:  # another worker is already compacting
+                return False
+            with self._locked_file():
+                if not (gens := self.segments()):
+                    return False
+                # writers move to the new segment, which leaves the old ones immutable
+                open(self.segment(gens[-1] + 1), "a").close()
+            # built from disk rather than memory, which may lag other workers
+            database = self.load(gens)
+            with self._locked_file():
+                self.write_snapshot(database)
+                for gen in gens:
+                    os.remove(self.segment(gen))
+        with self._lock:
+            self._size = 0
+            self._compacted = time.monotonic()
+        return True
+
+    def _run(self):
+        intervals = [interval for interval in (
+                self.fsync_interval if self.fsync == "interval" else None, self.compact_interval
+                ) if interval]
+        while True:
+            self._wake.wait(min(intervals, default=None))
+            self._wake.clear()
+            with self._lock:
+                if self._dirty and self._fd is not None:
+                    os.fsync(self._fd)
+                    self._dirty = False
+                due = self._size >= self.compact_bytes or bool(
+                        self._size and self.compact_interval
+                        and time.monotonic() - self._compacted >= self.compact_interval)
+            if due:
+                try:
+                    self.compact()
+                except OSError:  # retried on the next wakeup
+                    pass
+
+
+ENGINES = {"json": JsonStorage, "sqlite": SqliteStorage, "journal": JournalStorage}
+
+
+def migrate(source, target, *, source_engine="json", target_engine="sqlite"):
+    database = ENGINES[source_engine](source).load()
+    ENGINES[target_engine](target).save(database)
+    return len(database)
+
+
+class LoginDatabase:
+    def __init__(self, filename, *, engine="json", flush_interval=None, flush_batch=64, **engine_options):
+        if engine not in ENGINES:
+            raise ValueError(f"unknown storage engine {engine!r}, expected one of {tuple(ENGINES)}")
+        self.filename = filename
+        self.storage = ENGINES[engine](filename, **engine_options)
+        self.database = self.storage.load()
+        self._index_tokens()
+        self._stamp = self.storage.stamp()
+        self._lock = threading.RLock()
+        self._lock_file = None
+        self._lock_pid = None
+        self._lock_depth = 0
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._pending = set()
+        self._pending_all = False
+        self._pending_writes = 0
+        self._pending_lock = threading.Lock()
+        self._flusher_pid = None
+        self._wake = threading.Event()
+        if flush_interval is not None:
+            atexit.register(self.flush)
+
+    def _index_tokens(self):
+        # token -> username, so per-request session lookups skip the user scan
+        self._tokens = {entry[0]: username for username, entry in self.database.items()}
+
+    @contextmanager
+    def locked(self):
+        # serialises writers across threads (RLock) and across pre-forked
+        # worker processes (flock on a sidecar file)
+        with self._lock:
+            if self._lock_pid != os.getpid():
+                # flock is per open file, so each forked worker needs its own
+                self._lock_file = open(f"{self.filename}.lock", "a")
+                self._lock_pid = os.getpid()
+            if not self._lock_depth:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield self
+            finally:
+                self._lock_depth -= 1
+                if not self._lock_depth:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def refresh(self):
+        if (stamp := self.storage.stamp()) == self._stamp:
+            return False
+        # the thread lock keeps a reader's reload from swapping the dict out
+        # from under a writer between its own refresh and its save
+        with self._lock:
+            if (stamp := self.storage.stamp()) == self._stamp:
+                return False
+            # engines that can tell what changed hand back just that, so only
+            # those users are touched in the dict and the token index
+            if (tail := getattr(self.storage, "tail", None)) is None \
+                    or (changes := tail(self._stamp, stamp)) is None:
+                self.database = self.storage.load()
+                self._index_tokens()
+            else:
+                for username, entry in changes:
+                    if (old := self.database.get(username)) is not None:
+                        self._tokens.pop(old[0], None)
+                    if entry is None:
+                        self.database.pop(username, None)
+                    else:
+                        self.database[username] = entry
+                        self._tokens[entry[0]] = username
+            self._stamp = stamp
+        return True
+
+    def _save(self, usernames=None):
+        with self.locked():
+            self.storage.save(self.database, usernames)
+            self._stamp = self.storage.stamp()
+
+    def write_changes(self, *usernames):
+        # callers name the users they touched so row-based engines only
+        # rewrite those rows; no names means anything may have changed
+        if self.flush_interval is None:
+            return self._save(usernames or None)
+        # otherwise only mark them dirty; the flusher thread coalesces every
+        # write of an interval (or of a full batch) into one save
+        with self._pending_lock:
+            self._pending.update(usernames)
+            self._pending_all |= not usernames
+            self._pending_writes += 1
+            if self._flusher_pid != os.getpid():  # threads don't survive fork()
+                threading.Thread(target=self._flusher, daemon=True).start()
+                self._flusher_pid = os.getpid()
+            if self._pending_writes >= self.flush_batch:
+                self._wake.set()
+
+    def flush(self):
+        with self._pending_lock:
+            usernames, everything = self._pending, self._pending_all
+            self._pending, self._pending_all, self._pending_writes = set(), False, 0
+        if not (usernames or everything):
+            return False
+        try:
+            self._save(None if everything else tuple(usernames))
+        except BaseException:
+            with self._pending_lock:  # keep them for the next flush
+                self._pending |= usernames
+                self._pending_all |= everything
+            raise
+        return True
+
+    def _flusher(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:  # still pending, so the next tick retries
+                pass
 
     def add_user(self, username, password, *, properties={}, replace=False):
         if username in self.database and not replace:
             return False
         elif not username:
             return False
+        if (old := self.database.get(username)) is not None:
+            self._tokens.pop(old[0], None)
         self.database[username] = (
                 (t := hashlib.sha256(f"{username}:{password}".encode()).hexdigest()),
                 properties
                 )
-        self.write_changes()
+        self._tokens[t] = username
+        self.write_changes(username)
         return t
 
     def get_properties_from_token(self, token):
-        for tok, prop in self.database.values():
-            if tok == token:
-                return prop
-        return False
+        if not (username := self.get_user(token)):
+            return False
+        return self.database[username][1]
 
     def get_user(self, token):
-        for uname, tok in self.database.items():
-            if token == tok[0]:
-                return uname
-        return False
+        # a concurrent refresh() can briefly pair a new index with the old dict
+        if (username := self._tokens.get(token)) is None or username not in self.database:
+            return False
+        return username
 
     def remove_user(self, username):
         if username not in self.database:
             return False
-        del self.database[username]
-        self.write_changes()
+        self._tokens.pop(self.database.pop(username)[0], None)
+        self.write_changes(username)
         return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="copy a login database between storage engines")
+    parser.add_argument("source")
+    parser.add_argument("target")
+    parser.add_argument("--from", dest="source_engine", choices=ENGINES, default="json")
+    parser.add_argument("--to", dest="target_engine", choices=ENGINES, default="sqlite")
+    args = parser.parse_args()
+    if not os.path.isfile(args.source):
+        raise SystemExit(f"{args.source!r} doesn't exist")
+    print(f"migrated {migrate(args.source, args.target, source_engine=args.source_engine, target_engine=args.target_engine)} users "
+          f"from {args.source!r} ({args.source_engine}) to {args.target!r} ({args.target_engine})")
@@ -24,6 +24,10 @@ class Forum:
             } for idx, name in enumerate(os.listdir(root_dir)) \
                     if name != "roles.json"}
 
+    def refresh(self):
+        for name, info in self.sections.items():
+            info['threads'] = list(map(int, filter(str.isdigit, os.listdir(os.path.join(self.root_dir, name)))))
+
     def get_section(self, sid):
         if isinstance(sid, str):
             if not sid.isdigit():
@@ -61,9 +65,10 @@ class Forum:
             "title": escape(title),
             "content": escape(content)
             })['tid'])
-        os.mkdir(f"{self.root_dir}/{section}/{tid}")
-        with open(f"{self.root_dir}/{section}/{tid}/info", "w") as info:
+        os.mkdir(tmp := f"{self.root_dir}/{section}/.{tid}.tmp")
+        with open(f"{tmp}/info", "w") as info:
             json.dump(c, info)
+        os.rename(tmp, f"{self.root_dir}/{section}/{tid}")
         return tid
 
     def delete_thread(self, section, tid):
@@ -81,7 +86,7 @@ class Forum:
         elif len(self.sections[section]['threads']) < tid:
             return False
         pid = len(os.listdir(f"{self.root_dir}/{section}/{tid}"))
-        with open(f"{self.root_dir}/{section}/{tid}/{pid}.reply", "w") as post:
+        with open((tmp := f"{self.root_dir}/{section}/{tid}/.{pid}.tmp"), "w") as post:
             json.dump({
                 "pid": pid,
                 "ip": ip,
@@ -90,6 +95,7 @@ class Forum:
                 "content": escape(content)
                 }, post
                 )
+        os.replace(tmp, f"{self.root_dir}/{section}/{tid}/{pid}.reply")
         return pid
 
     def delete_reply(self, section, tid, pid):
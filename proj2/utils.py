@@ -1,5 +1,12 @@
+from api.http_server import Response, header_line, status_line
+from collections import OrderedDict
+from functools import lru_cache
 from os import urandom
+from string import Formatter
+import os
 import socket
+import threading
+import time
 
 
 def deconcat(num, pad):
@@ -20,9 +27,7 @@ def encode_websocket(data):
     elif 2**16 < len(data) <= 2**64:
         payload_len = chr(127)
         payload_len_extra = deconcat(len(data), 8)
-    a = f"\x81{payload_len}{payload_len_extra}{data}".encode()
-    print(a)
-    return a
+    return f"\x81{payload_len}{payload_len_extra}{data}".encode()
 
 
 def concat(seq):
@@ -74,54 +79,219 @@ def censor_ip(ip):
     return f"{a}.x.x.{d}"
 
 
-def determine_template(data, username, *args, **kwargs):
-    return data.format(
-            items=f"""
+GUEST_NAVIGATION = """
             <li>
-                <a href="/logout">Logout</a>
+                <a href="/login">Login</a>
             </li>
             <li>
-                <a href="/member-list">Member list</a>
+                <a href="/register">Register</a>
             </li>
             <li>
-                <a href="/chat">Chatbox</a>
+                <a href="/member-list">Member list</a>
             </li>
             <li>
                 <a href="/about">About</a>
             </li>
-            <li id="username">
-                <a href="/profile">{username}</a>
-            </li>
-            <li id="inbox">
-                <a href="/inbox">Inbox</a>
-            </li>
-            """ if username != "Guest" else """
+            """.encode()
+MEMBER_NAVIGATION = """
             <li>
-                <a href="/login">Login</a>
+                <a href="/logout">Logout</a>
             </li>
             <li>
-                <a href="/register">Register</a>
+                <a href="/member-list">Member list</a>
             </li>
             <li>
-                <a href="/member-list">Member list</a>
+                <a href="/chat">Chatbox</a>
             </li>
             <li>
                 <a href="/about">About</a>
             </li>
-            """,
-            *args, **kwargs)
+            <li id="username">
+                <a href="/profile">{username}</a>
+            </li>
+            <li id="inbox">
+                <a href="/inbox">Inbox</a>
+            </li>
+            """
+
+
+class Template:
+    CONVERSIONS = {"r": repr, "s": str, "a": ascii}
+
+    def __init__(self, text):
+        self.segments = []
+        auto_index = 0
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if literal:
+                self.segments.append(literal.encode())
+            if field is None:
+                continue
+            elif field == "":
+                field, auto_index = auto_index, auto_index + 1
+            elif field.isdigit():
+                field = int(field)
+            self.segments.append((field, spec, conversion))
+
+    def render(self, *args, **kwargs):
+        chunks = []
+        for segment in self.segments:
+            if segment.__class__ is bytes:
+                chunks.append(segment)
+                continue
+            field, spec, conversion = segment
+            value = args[field] if isinstance(field, int) else kwargs[field]
+            if conversion:
+                value = Template.CONVERSIONS[conversion](value)
+            if spec:
+                chunks.append(format(value, spec).encode())
+            elif value.__class__ is bytes:
+                chunks.append(value)
+            elif value.__class__ is list:
+                chunks.extend(value)
+            else:
+                chunks.append(str(value).encode())
+        return chunks
+
+    def iter_render(self, *args, **kwargs):
+        for segment in self.segments:
+            if segment.__class__ is bytes:
+                yield segment
+                continue
+            field, spec, conversion = segment
+            value = args[field] if isinstance(field, int) else kwargs[field]
+            if conversion:
+                value = Template.CONVERSIONS[conversion](value)
+            if spec:
+                yield format(value, spec).encode()
+            elif value.__class__ is bytes:
+                yield value
+            elif value.__class__ is str:
+                yield value.encode()
+            elif hasattr(value, "__iter__"):
+                for chunk in value:
+                    yield chunk.encode() if chunk.__class__ is str else chunk
+            else:
+                yield str(value).encode()
+
+
+@lru_cache(maxsize=64)
+def compile_template(text):
+    return Template(text)
+
+
+@lru_cache(maxsize=1024)
+def navigation(username):
+    if username == "Guest":
+        return [GUEST_NAVIGATION]
+    return compile_template(MEMBER_NAVIGATION).render(username=username)
+
+
+def determine_template(data, username, *args, **kwargs):
+    return compile_template(data).render(*args, items=navigation(username), **kwargs)
+
+
+def stream_template(data, username, *args, **kwargs):
+    return compile_template(data).iter_render(*args, items=navigation(username), **kwargs)
 
 
 def construct_http_response(version, status_code, reason_phrase, headers, content):
-    a= (f"{version} {status_code} {reason_phrase}\r\n"
-        + "".join(f"{k.split('#', 1)[0]}: {v}\r\n" for k, v in headers.items()) + "\r\n"
-        + content).encode()
-    return a
+    status = status_line(version, status_code, reason_phrase)
+    headers = [header_line(k, v) for k, v in headers.items()]
+    if isinstance(content, str):
+        return Response(status, headers, (content.encode(),) if content else ())
+    elif isinstance(content, (bytes, bytearray, memoryview)):
+        return Response(status, headers, (content,))
+    elif not isinstance(content, (list, tuple)):
+        return Response(status, headers, stream=content)
+    return Response(status, headers, content)
 
 
-def read_file(root_dir, name):
-    try:
-        with open(f"{root_dir}/{name}") as file_:
-            return file_.read()
-    except FileNotFoundError:
+class CachedFile:
+    __slots__ = ("text", "data", "stamp", "checked")
+
+    def __init__(self, data, stamp, checked):
+        self.data = data
+        self.text = data.decode()
+        if "\r" in self.text:  # match the universal newlines of open()
+            self.text = self.text.replace("\r\n", "\n").replace("\r", "\n")
+        self.stamp = stamp
+        self.checked = checked
+
+    def __len__(self):
+        return len(self.data) + len(self.text)
+
+
+class FileCache:
+    def __init__(self, *, max_size=8 * 1024 * 1024, revalidate_interval=1.0):
+        self.max_size = max_size
+        self.revalidate_interval = revalidate_interval
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def _drop(self, path):
+        if (entry := self.entries.pop(path, None)) is not None:
+            self.size -= len(entry)
+
+    def get(self, path):
+        now = time.monotonic()
+        with self._lock:
+            if (entry := self.entries.get(path)) is not None:
+                self.entries.move_to_end(path)
+                if now - entry.checked < self.revalidate_interval:
+                    self.hits += 1
+                    return entry
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._drop(path)
+            return None
+        stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if entry is not None and entry.stamp == stamp:
+            entry.checked = now
+            with self._lock:
+                self.hits += 1
+            return entry
+        try:
+            with open(path, "rb") as file_:
+                entry = CachedFile(file_.read(), stamp, now)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self.misses += 1
+            self._drop(path)
+            if len(entry) <= self.max_size:
+                self.entries[path] = entry
+                self.size += len(entry)
+                while self.size > self.max_size:
+                    self._drop(next(iter(self.entries)))
+                    self.evictions += 1
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": len(self.entries),
+                    "size": self.size
+                    }
+
+
+file_cache = FileCache()
+
+
+def read_file(root_dir, name, *, encoded=False):
+    if (entry := file_cache.get(f"{root_dir}/{name}")) is None:
         return False
+    return entry.data if encoded else entry.text
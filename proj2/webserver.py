@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
+from api.async_http_server import AsyncHttpServer
 from api.http_server import HttpServer
 from database import LoginDatabase
-from functools import partial
+from functools import partial, wraps
 from forum import Forum
 from html import escape
+from itertools import chain
 import base64
 import hashlib
 import json
 import os
+import signal
 import socket
 import threading
 import time
@@ -17,6 +20,11 @@ import utils
 CONFIG_KEYS = ("host", "port", "root_dir", "logger_file", "database_file")
 FORUM_TITLE = "Unazed's Forum"
 ACCEPTABLE_WILDCARDS = ("css", "js")
+SERVER_MODES = {
+    "threaded": (HttpServer, "handle_http_connections"),
+    "reactor": (HttpServer, "handle_http_reactor"),
+    "async": (AsyncHttpServer, "handle_http_connections")
+    }
 
 
 def index(server, conn, addr, method, params, route, cookies):
@@ -105,10 +113,10 @@ def index(server, conn, addr, method, params, route, cookies):
                     ))
             author = author[1]
             return conn.send(utils.construct_http_response(
-                200, "OK", {}, utils.determine_template(
+                200, "OK", {}, utils.stream_template(
                     data, username,
                     forum_title=FORUM_TITLE,
-                    body=f"""
+                    body=chain((f"""
                     <p id="thd_title"><a href="/index?sid={sid}" id="title_sid">{section[0]}</a> > {thread['title']}</p>
                     <div id="thread">
                         <div id="profile">
@@ -122,8 +130,8 @@ def index(server, conn, addr, method, params, route, cookies):
                         </div>
                     </div>
                     <ul class="posts">
-                    """ +
-                    ''.join(f"""
+                    """,),
+                    (f"""
                         <li id="post">
                             <div id="post_div">
                                 <p id="ip_sig">{utils.censor_ip(reply['ip'])}</p>
@@ -133,8 +141,8 @@ def index(server, conn, addr, method, params, route, cookies):
                                 <p id="post_content">{reply['content']}</p>
                             </div>
                         </li>
-                        """ for reply in sorted(replies, key=lambda r: r['pid']))
-                    + """
+                        """ for reply in sorted(replies, key=lambda r: r['pid'])),
+                    ("""
                     </ul>
                     <form id="post_form" method="post"
                      onsubmit="postbtn.disabled=true;postbtn.value='Posting...'">
@@ -142,7 +150,7 @@ def index(server, conn, addr, method, params, route, cookies):
                         <input type="hidden" name="action" value="make_reply" />
                         <input name="postbtn" id="postbtn" type="submit" value="Post" />
                     </form>
-                    """
+                    """,))
                     )
                 ))
     elif g and (p := params['POST']):
@@ -152,7 +160,6 @@ def index(server, conn, addr, method, params, route, cookies):
         elif not sid.isdigit():
             return server.get_route(conn, addr, "GET", "/400")
         sid = int(sid)
-        print(sid, p)
         if not (section := server._forum.get_section(sid)):
             return server.get_route(conn, addr, "GET", "/404")
         elif server._db.database[username][1]['role'] not in section[1]['allowed_roles']:
@@ -172,7 +179,7 @@ def index(server, conn, addr, method, params, route, cookies):
                 'title': title,
                 'content': content
                 })
-            server._db.write_changes()
+            server._db.write_changes(username)
             return conn.send(utils.construct_http_response(
                 301, "Redirect", {"Location": f"/index?sid={sid}&tid={tid}"}, ""
                 ))
@@ -193,7 +200,7 @@ def index(server, conn, addr, method, params, route, cookies):
                 'sid': section[1]['sid'],
                 "section": section[0]
                 })
-            server._db.write_changes()
+            server._db.write_changes(username)
             return conn.send(utils.construct_http_response(
                 301, "Redirect", {"Location": f"/index?tid={tid}&sid={sid}"}, ""
                 ))
@@ -222,7 +229,7 @@ def register(server, conn, addr, method, params, route, cookies):
             200, "OK", {}, utils.determine_template(
                 index, username,
                 forum_title=FORUM_TITLE,
-                body=data.format(error=error)
+                body=utils.compile_template(data).render(error=error)
                 )
             ))
     elif method == "POST":
@@ -246,7 +253,7 @@ def register(server, conn, addr, method, params, route, cookies):
                     }
                     )):
             return server.get_route(conn, addr, "GET", "/register?error=The username entered is either invalid or taken.")
-        print(f"[WebServer] user registered: {params['POST']['username']!r}")
+        server.log(f"[WebServer] user registered: {params['POST']['username']!r}")
         return conn.send(utils.construct_http_response(
             301, "Redirect", {
                 "Location": "/index",
@@ -279,7 +286,7 @@ def login(server, conn, addr, method, params, route, cookies):
             200, "OK", {}, utils.determine_template(
                 index, username,
                 forum_title=FORUM_TITLE,
-                body=data.format(error=error)
+                body=utils.compile_template(data).render(error=error)
                 )
             ))
     elif method == "POST":
@@ -289,7 +296,6 @@ def login(server, conn, addr, method, params, route, cookies):
             return server.get_route(conn, addr, "GET", "/403")
         elif not server._db.get_user((t := hashlib.sha256(f"{escape(u)}:{params['POST']['password']}".encode()).hexdigest())):
             return server.get_route(conn, addr, "GET", "/403")
-        print(u, params['POST']['password'])
         return conn.send(utils.construct_http_response(
             301, "Redirect", {
                 "Set-Cookie": f"token={t}",
@@ -336,7 +342,7 @@ def error_handler(server, conn, addr, method, param, route, cookies):
         status = int(host[1:])
 
     return conn.send(utils.construct_http_response(
-        status, "Error", {}, index.format(
+        status, "Error", {}, utils.compile_template(index).render(
                 forum_title=FORUM_TITLE,
                 body="<p>An error has been encountered during the processing of this request.<br>" \
                     f"Code: {host}</p>",
@@ -585,7 +591,6 @@ def profile(server, conn, addr, method, params, route, cookies):
 def profile_action(server, conn, addr, method, params, route, cookies):
     username = server._db.get_user(cookies.get("token", "")) or "Guest"
     properties = server._db.database[username][1]
-    print(params)
     if not (index := utils.read_file("index.html")):
         return server.get_route(conn, addr, "GET", "/404")
     elif not (action := params["POST"].get("action", "")):
@@ -614,7 +619,7 @@ def profile_action(server, conn, addr, method, params, route, cookies):
         rating = int(rating)
         server._db.database[recv_name][1]['reputation_content'][username] = [rating, escape(content[:100]) if content.strip() else "<i>No comment</i>"]
         server._db.database[recv_name][1]['reputation'] = sum(rep[0] for rep in server._db.database[recv_name][1]['reputation_content'].values())
-        server._db.write_changes()
+        server._db.write_changes(recv_name)
         return conn.send(utils.construct_http_response(
             301, "Redirect", {"Location": f"/profile?uid={uid}"}, ""
             ))
@@ -624,7 +629,7 @@ def profile_action(server, conn, addr, method, params, route, cookies):
         elif username != recv_name and not server._db.database[username][1]['role'] == "admin":
             return server.get_route(conn, addr, "GET", "/403")
         server._db.database[recv_name][1]['biography'] = escape(content)
-        server._db.write_changes()
+        server._db.write_changes(recv_name)
         return conn.send(utils.construct_http_response(
             301, "Redirect", {"Location": f"/profile?uid={uid}"}, ""
             )) 
@@ -649,7 +654,7 @@ def profile_action(server, conn, addr, method, params, route, cookies):
             "content": content,
             "type": "sent"
             })
-        server._db.write_changes()
+        server._db.write_changes(recv_name, username)
         return conn.send(utils.construct_http_response(
             301, "Redirect", {"Location": f"/profile?uid={uid}"}, ""
             ))
@@ -685,16 +690,16 @@ def inbox(server, conn, addr, method, params, route, cookies):
         elif pm["type"] == "sent":
             sent.append(pm)
     return conn.send(utils.construct_http_response(
-        200, "OK", {}, utils.determine_template(
+        200, "OK", {}, utils.stream_template(
             index, username,
             forum_title=FORUM_TITLE,
-            body=f"""
+            body=chain((f"""
             <div id="received">
                 <p id="title">Received PMs</p>
                 <div id="pm-list">
                     <ul>
-                    """ +
-                        ''.join(
+                    """,),
+                        (
                             f"""
                             <li onclick="show_pm('from-pm-view', 'from-pm', {pm['id']});">
                                 <p id="from">
@@ -703,20 +708,20 @@ def inbox(server, conn, addr, method, params, route, cookies):
                             </li>
                             """
                             for pm in received
-                            )
-                    + """
+                            ),
+                    ("""
                     </ul>
                     <div id="from-pm-view">
-                    """ +
-                        ''.join(
+                    """,),
+                        (
                             f"""
                             <div style="display: none;" id="from-pm-{pm['id']}">
                                 <p id="content">{pm['content']}</p>
                             </div>
                             """
                             for pm in received
-                        )
-                    + """
+                        ),
+                    ("""
                     </div>
                 </div>
             </div>
@@ -725,8 +730,8 @@ def inbox(server, conn, addr, method, params, route, cookies):
                 <p id="title">Sent PMs</p>
                 <div id="pm-list">
                     <ul>
-                    """ +
-                    ''.join(
+                    """,),
+                    (
                         f"""
                         <li onclick="show_pm('to-pm-view', 'to-pm', {pm['id']});">
                             <p id="to">
@@ -734,24 +739,24 @@ def inbox(server, conn, addr, method, params, route, cookies):
                             </p>
                         </li>
                         """ for pm in sent
-                        )
-                    + """
+                        ),
+                    ("""
                     </ul>
                     <div id="to-pm-view">
-                    """ +
-                        ''.join(
+                    """,),
+                        (
                             f"""
                             <div style="display: none;" id="to-pm-{pm['id']}">
                                 <p type="hidden" id="content">{pm['content']}</p>
                             </div>
                             """
                             for pm in sent
-                        )
-                    + """
+                        ),
+                    ("""
                     </div>
                 </div>
             </div>
-            """
+            """,))
             )
         ))
 
@@ -849,41 +854,72 @@ def member_list(server, conn, addr, method, params, route, cookies):
     username = server._db.get_user(cookies.get("token", "")) or "Guest"
     if not (index := utils.read_file("index.html")):
         return server.get_route(conn, addr, "GET", "/404")
+    members = list(server._db.database.items())
     return conn.send(utils.construct_http_response(
-        200, "OK", {}, utils.determine_template(
+        200, "OK", {}, utils.stream_template(
             index, username,
             forum_title=FORUM_TITLE,
-            body=f"""
+            body=chain((f"""
             <div id="member-list">
                 <p id="subtitle">Member listing</p>
                 <ul id="member-list">
-                """ +
-                '\n'.join(f"""
+                """,),
+                (f"""
                     <li style="background-image: linear-gradient(to right, #2e2e2e, {server._forum.roles[info[1]['role']]['background-color']})">
                         <p class="member-item">
                             <a href="/profile?uid={info[1]['uid']}">{member}</a>
                         </p>
                     </li>
-                    """ for member, info in server._db.database.items())
-            + """
+                    """ for member, info in members),
+            ("""
                 </ul>
             </div>
-            """
+            """,))
             )
         ))
 
 
+def thread(server, conn, addr, method, params, route, cookies):
+    params["GET"] = {**params["GET"], **params["PATH"]}
+    return index(server, conn, addr, method, params, route, cookies)
+
+
 def global_handler(server, conn, addr, method, params, route, cookies):
     path = params['path']
     _, *ext = path.split(".")
     if not ext:
         return server.get_route(conn, addr, "GET", "/404")
-    if ext[0] in ACCEPTABLE_WILDCARDS:
-        if not (data := utils.read_file(path)):
+    if ext[-1] in ACCEPTABLE_WILDCARDS:
+        if not server.static_files.serve(conn, path):
             return server.get_route(conn, addr, "GET", "/404")
-        return conn.send(utils.construct_http_response(
-            200, "OK", {"Cache-Control": "no-store"}, data
-            ))
+
+
+def consistent(handler):
+    # pre-forked workers each hold their own copy of the login database and
+    # forum; reload both whenever another worker has written, and run
+    # anything that may write behind the database's cross-process lock
+    @wraps(handler)
+    def wrapper(server, conn, addr, method, params, route, cookies):
+        if method != "POST" and params.get("GET", {}).get("action") != "delete":
+            server._db.refresh()
+            server._forum.refresh()
+            return handler(server, conn, addr, method, params, route, cookies)
+        with server._db.locked():
+            server._db.refresh()
+            server._forum.refresh()
+            return handler(server, conn, addr, method, params, route, cookies)
+    return wrapper
+
+
+def stop(signum, frame):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)  # don't interrupt the final flush
+    raise KeyboardInterrupt
+
+
+def add_route(methods_supported, path, handler):
+    if workers > 1:
+        handler = consistent(handler)
+    return server.add_route(methods_supported, path, handler)
 
 
 if __name__ != "__main__":
@@ -903,18 +939,45 @@ host, port = config['host'], config['port']
 root_dir = config['root_dir']
 logger_file = config['logger_file'] or None
 database_file = config['database_file']
+workers = int(config.get("workers", 1))
+if (mode := config.get("mode", "threaded")) not in SERVER_MODES:
+    raise KeyError(f"[WebServer] unknown server mode {mode!r}, expected one of {tuple(SERVER_MODES)}")
 
+utils.file_cache = utils.FileCache(**config.get("file_cache", {}))
 utils.read_file = partial(utils.read_file, root_dir)
 utils.construct_http_response = partial(utils.construct_http_response, HttpServer.SUPPORTED_HTTP_VERSION)
 
-server = HttpServer(
+server_class, serve = SERVER_MODES[mode]
+server = server_class(
         root_dir=root_dir,
         host=host,
         port=int(port),
-        logger_file=logger_file
+        logger_file=logger_file,
+        log_options=config.get("log_options", {}),
+        **config.get("server_options", {})
         )
+server.metrics.gauge("file_cache_hits_total", "utils.read_file lookups served from the cache.",
+        lambda: utils.file_cache.stats()['hits'], kind="counter")
+server.metrics.gauge("file_cache_misses_total", "utils.read_file lookups that read the file.",
+        lambda: utils.file_cache.stats()['misses'], kind="counter")
+server.metrics.gauge("file_cache_evictions_total", "Files evicted from the cache to stay under max_size.",
+        lambda: utils.file_cache.stats()['evictions'], kind="counter")
+server.metrics.gauge("file_cache_entries", "Files held in the cache.",
+        lambda: utils.file_cache.stats()['entries'])
+server.metrics.gauge("file_cache_size", "Size of the cached files, counting text and bytes.",
+        lambda: utils.file_cache.stats()['size'])
 
-server._db = LoginDatabase(database_file)
+database_options = config.get("database_options", {})
+if workers > 1 and database_options.pop("flush_interval", None) is not None:
+    # a worker must publish its writes before releasing the database lock
+    server.log("[WebServer] 'flush_interval' is ignored with workers > 1")
+server._db = LoginDatabase(database_file, engine=config.get("database_engine", "json"), **database_options)
+server._db.write_changes = server.metrics.timed(
+        "login_db_write_changes_seconds", "Time spent in LoginDatabase.write_changes."
+        )(server._db.write_changes)
+server._db.flush = server.metrics.timed(
+        "login_db_flush_seconds", "Time spent saving deferred writes in LoginDatabase.flush."
+        )(server._db.flush)
 server._forum = Forum(server._db, "forum/")
 
 server._db.add_user("Admin", "", properties={
@@ -949,31 +1012,44 @@ server._forum.add_section("Public", ["guest", "member", "admin"])
 server._forum.add_section("Lounge", ["member", "admin"])
 server._forum.add_section("Admin-Only", ["admin"])
 
-print(server._forum.sections)
+server.log(f"[WebServer] sections: {server._forum.sections}")
 
-server.add_route(["GET", "POST"], "/", index)
-server.add_route(["GET", "POST"], "/index", index)
+add_route(["GET", "POST"], "/", index)
+add_route(["GET", "POST"], "/index", index)
+add_route(["GET", "POST"], "/thread/{sid}/{tid}", thread)
 
-server.add_route(["GET", "POST"], "/login", login)
-server.add_route(["GET", "POST"], "/register", register)
-server.add_route(["GET"], "/logout", logout)
-server.add_route(["GET"], "/make-thread", make_thread)
-server.add_route(["GET"], "/member-list", member_list)
-server.add_route(["GET"], "/profile", profile)
-server.add_route(["GET"], "/about", about)
-server.add_route(["POST"], "/profile_action", profile_action)
-server.add_route(["GET"], "/inbox", inbox)
-server.add_route(["GET"], "/chat", chat)
+add_route(["GET", "POST"], "/login", login)
+add_route(["GET", "POST"], "/register", register)
+add_route(["GET"], "/logout", logout)
+add_route(["GET"], "/make-thread", make_thread)
+add_route(["GET"], "/member-list", member_list)
+add_route(["GET"], "/profile", profile)
+add_route(["GET"], "/about", about)
+add_route(["POST"], "/profile_action", profile_action)
+add_route(["GET"], "/inbox", inbox)
+add_route(["GET"], "/chat", chat)
 
 server._ws_threads = {}
+server.metrics.gauge("websocket_clients", "Chat websocket clients connected to this process.",
+        lambda: len(server._ws_threads))
 server._halted = False
-server.add_route(["websocket"], "/chat_feed", chat_feed)  # ;(
+add_route(["websocket"], "/chat_feed", chat_feed)  # ;(
 
-server.add_route(["GET"], "/404", error_handler)
-server.add_route(["GET"], "/403", error_handler)
-server.add_route(["GET"], "/400", error_handler)
-server.add_route(["GET"], "/405", error_handler)
+add_route(["GET"], "/404", error_handler)
+add_route(["GET"], "/403", error_handler)
+add_route(["GET"], "/400", error_handler)
+add_route(["GET"], "/405", error_handler)
 
-server.add_route(["GET"], "/*", global_handler)
-server.handle_http_connections()
+add_route(["GET"], "/*", global_handler)
+if (metrics := config.get("metrics")) is not None:
+    server.add_metrics_route(**metrics)
+if (profiler := config.get("profiler")) is not None:
+    server.add_profiler_route(**{key: profiler.pop(key) for key in ("path", "allow") if key in profiler})
+    server.profiler.configure(**profiler)
+if workers > 1:
+    server.handle_http_prefork(workers, serve=serve, **config.get("mode_options", {}))
+else:
+    signal.signal(signal.SIGTERM, stop)  # so a plain kill still flushes deferred writes
+    getattr(server, serve)(**config.get("mode_options", {}))
 server._halted = True
+server._db.flush()